@@ -1,4 +1,4 @@
-import arrow
+import datetime
 
 from marty.commands import Command
 from marty.operations.backup import create_backup
@@ -15,7 +15,7 @@ class Backup(Command):
     def prepare(self):
         self._aparser.add_argument('remote')
         self._aparser.add_argument('name', nargs='?',
-                                   default=arrow.now().strftime('%Y-%m-%d_%H-%M-%S'))
+                                   default=datetime.datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
         self._aparser.add_argument('-o', '--overwrite', action='store_true',
                                    help='Overwrite existing backup')
         self._aparser.add_argument('-p', '--parent',
@@ -38,11 +38,8 @@ class Backup(Command):
         else:
             parent = None
 
-        ref, backup = create_backup(storage, remote, parent=parent)
-
-        # Create labels for the new backup:
-        storage.set_label(backup_label, ref)
-        storage.set_label('%s/latest' % remote.name, ref)
+        ref, backup = create_backup(storage, remote, parent=parent,
+                                    labels=[backup_label, '%s/latest' % remote.name])
 
         printer.p('<b>Duration:</b> {d}', d=backup.duration)
         printer.p('<b>Root:</b> {r}', r=backup.root)
@@ -1,8 +1,17 @@
+import time
+import datetime
+
+import humanize
+
 from marty.commands import Command
-from marty.operations.objects import check
+from marty.operations.objects import check, check_plan, SCRUB_POSITION_KEY
 from marty.printer import printer
 
 
+PROGRESS_INTERVAL = 10  # seconds
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
+
+
 class Check(Command):
 
     """ Check all object into the pool.
@@ -10,5 +19,70 @@ class Check(Command):
 
     help = 'Check all object into the pool'
 
+    def prepare(self):
+        self._aparser.add_argument('-u', '--unverified', action='store_true',
+                                   help='Only check objects never verified')
+        self._aparser.add_argument('-o', '--older-than', type=int, metavar='DAYS',
+                                   help='Only check objects not verified since this number of days')
+        self._aparser.add_argument('-t', '--time-budget', type=int, metavar='MINUTES',
+                                   help='Stop after this duration')
+        self._aparser.add_argument('-b', '--size-budget', type=int, metavar='GIB',
+                                   help='Stop after checking this amount of data')
+        self._aparser.add_argument('-w', '--workers', type=int,
+                                   help='Number of workers (default from storage configuration)')
+        self._aparser.add_argument('-s', '--status', action='store_true',
+                                   help='Only show the status of previous checks and scrubbing')
+
+    def status(self, storage):
+        count, corrupted, oldest = storage.checklog.stats()
+        printer.p('<b>Checked objects:</b> {n}', n=count)
+        printer.p('<b>Corrupted objects:</b> {n}', n=corrupted)
+        if oldest is not None:
+            printer.p('<b>Oldest check:</b> {d}', d=datetime.datetime.fromtimestamp(oldest).strftime(DATE_FORMAT))
+        printer.p('<b>Scrubbing position:</b> {p}', p=storage.checklog.get_state(SCRUB_POSITION_KEY) or '-')
+        for ref in storage.checklog.corrupted():
+            printer.p(ref)
+
     def run(self, args, config, storage, remotes):
-        check(storage)
+        if args.status:
+            self.status(storage)
+            return
+
+        if args.unverified:
+            since = 0  # Any verification is recent enough
+        elif args.older_than is not None:
+            since = time.time() - args.older_than * 86400
+        else:
+            since = None
+        time_budget = args.time_budget * 60 if args.time_budget is not None else None
+        size_budget = args.size_budget * 1024 ** 3 if args.size_budget is not None else None
+
+        total_count, total_size = check_plan(storage, since)
+        if size_budget is not None:
+            total_size = min(total_size, size_budget)
+        printer.p('Checking {n} objects, {s}', n=total_count, s=humanize.naturalsize(total_size, binary=True))
+
+        start = last_progress = time.time()
+        count = 0
+        size = 0
+        corrupted = []
+        for ref, object_size, valid in check(storage, since=since, workers=args.workers,
+                                             time_budget=time_budget, size_budget=size_budget):
+            printer.verbose('Checked {ref}', ref=ref, err=True)
+            count += 1
+            size += object_size
+            if not valid:
+                corrupted.append(ref)
+                printer.p(ref)
+            if time.time() - last_progress >= PROGRESS_INTERVAL:
+                last_progress = time.time()
+                throughput = size / (last_progress - start)
+                eta = datetime.timedelta(seconds=int((total_size - size) / throughput)) if throughput else '?'
+                printer.p('{n}/{t} objects, {s} ({r}/s), ETA: {e}', n=count, t=total_count,
+                          s=humanize.naturalsize(size, binary=True),
+                          r=humanize.naturalsize(throughput, binary=True), e=eta, err=True)
+
+        duration = time.time() - start
+        printer.p('Done. Checked {n} objects, {s} in {d:.1f}s ({r}/s), {c} corrupted', n=count,
+                  s=humanize.naturalsize(size, binary=True), d=duration,
+                  r=humanize.naturalsize(size / duration if duration else 0, binary=True), c=len(corrupted))
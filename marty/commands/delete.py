@@ -0,0 +1,38 @@
+import humanize
+
+from marty.commands import Command
+from marty.operations.labels import delete_label
+from marty.operations.refcounts import exclusive_size
+from marty.printer import printer
+
+
+class Delete(Command):
+
+    """ Delete a backup label.
+    """
+
+    help = 'Delete a backup label'
+
+    def prepare(self):
+        self._aparser.add_argument('remote', nargs='?')
+        self._aparser.add_argument('name')
+        self._aparser.add_argument('-r', '--dry-run', action='store_true',
+                                   help='Only show the space which would be freed')
+
+    def run(self, args, config, storage, remotes):
+        name = '%s/%s' % (args.remote, args.name) if args.remote else args.name
+        ref = storage.read_label(name)
+        if ref is None:
+            raise RuntimeError('Unknown label %s' % name)
+        if args.dry_run:
+            if storage.refcounts is None:
+                raise RuntimeError('Refcount index is not enabled on this storage')
+            count, size = exclusive_size(storage, [ref])
+            printer.p('Would free {n} objects, total size: {s}', n=count, s=humanize.naturalsize(size, binary=True))
+        else:
+            count, size = delete_label(storage, name)
+            if storage.refcounts is None:
+                printer.p('Deleted label {l}, run gc to free unused objects', l=name)
+            else:
+                printer.p('Deleted label {l}. Freed {n} objects, total size: {s}', l=name, n=count,
+                          s=humanize.naturalsize(size, binary=True))
@@ -0,0 +1,48 @@
+import json
+
+from marty.commands import Command
+from marty.operations.diff import diff_trees, ADDED, REMOVED, MODIFIED, METADATA
+from marty.printer import printer
+
+
+CHANGES_FORMAT = {ADDED: '<color fg=green>+ {p}</color>',
+                  REMOVED: '<color fg=red>- {p}</color>',
+                  MODIFIED: '<color fg=yellow>M {p}</color>',
+                  METADATA: '<color fg=cyan>m {p}</color>'}
+
+
+def _ref(item):
+    if item is None:
+        return None
+    elif 'data' in item:
+        return '(inline)'
+    else:
+        return item.ref
+
+
+class Diff(Command):
+
+    """ Show differences between two backups or trees.
+    """
+
+    help = 'Show differences between two backups or trees'
+
+    def prepare(self):
+        self._aparser.add_argument('old')
+        self._aparser.add_argument('new')
+        self._aparser.add_argument('-j', '--json', action='store_true',
+                                   help='Output a JSON object per line')
+
+    def run(self, args, config, storage, remotes):
+        old = storage.get_tree(args.old)
+        new = storage.get_tree(args.new)
+        for change, path, old_item, new_item in diff_trees(storage, old, new):
+            if args.json:
+                line = json.dumps({'change': change,
+                                   'path': path.decode('utf-8', 'surrogateescape'),
+                                   'type': (old_item if new_item is None else new_item).type,
+                                   'old': _ref(old_item),
+                                   'new': _ref(new_item)})
+                printer.p('{l}', l=line, markup=False)
+            else:
+                printer.p(CHANGES_FORMAT[change], p=path.decode('utf-8', 'replace'))
@@ -0,0 +1,42 @@
+import humanize
+
+from marty.commands import Command
+from marty.operations.objects import item_totals
+from marty.printer import printer
+
+
+ORDERS = {'name': lambda x: x[0],
+          'size': lambda x: -x[1],
+          'count': lambda x: -x[2]}
+
+
+class Du(Command):
+
+    """ Show the size of each item of a tree.
+    """
+
+    help = 'Show the size of each item of a tree'
+
+    def prepare(self):
+        self._aparser.add_argument('remote', nargs='?')
+        self._aparser.add_argument('name')
+        self._aparser.add_argument('-o', '--order', choices=ORDERS, default='name')
+
+    def run(self, args, config, storage, remotes):
+        name = '%s/%s' % (args.remote, args.name) if args.remote else args.name
+        tree = storage.get_tree(name)
+        lines = []
+        for name, item in tree.stream_items():
+            size, count = item_totals(storage, item)
+            lines.append((name, size, count, item.type))
+
+        table_lines = [('<b>SIZE</b>', '<b>ITEMS</b>', '<b>NAME</b>')]
+        for name, size, count, type in sorted(lines, key=ORDERS[args.order]):
+            name = name.decode('utf-8', 'replace')
+            if type == 'tree':
+                name = '<b><color fg=blue>%s/</color></b>' % name
+            table_lines.append((humanize.naturalsize(size, binary=True), str(count), name))
+        table_lines.append(('<b>%s</b>' % humanize.naturalsize(sum(x[1] for x in lines), binary=True),
+                            '<b>%s</b>' % sum(x[2] for x in lines),
+                            '<b>total</b>'))
+        printer.table(table_lines)
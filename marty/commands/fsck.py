@@ -0,0 +1,30 @@
+from marty.commands import Command
+from marty.operations.objects import fsck
+from marty.printer import printer
+
+
+class Fsck(Command):
+
+    """ Check that objects used by backups exist and decode.
+    """
+
+    help = 'Check that objects used by backups exist and decode'
+
+    def prepare(self):
+        self._aparser.add_argument('-v', '--verify', action='store_true',
+                                   help='Also check hash of referenced objects')
+        self._aparser.add_argument('-w', '--workers', type=int,
+                                   help='Number of workers (default from storage configuration)')
+
+    def run(self, args, config, storage, remotes):
+        damaged = set()
+        count = 0
+        for labels, path, ref, error in fsck(storage, verify=args.verify, workers=args.workers):
+            damaged.update(labels)
+            count += 1
+            printer.p('<b>{l}</b>:{p} {r} <color fg=red>{e}</color>', l=', '.join(sorted(labels)),
+                      p=path.decode('utf-8', 'replace'), r=ref, e=error)
+        if count:
+            printer.p('Found {n} damaged items in {b} labels', n=count, b=len(damaged))
+        else:
+            printer.p('Done. No damaged backup.')
@@ -1,3 +1,6 @@
+import time
+import resource
+
 import humanize
 
 from marty.commands import Command
@@ -15,10 +18,18 @@ class Gc(Command):
     def prepare(self):
         self._aparser.add_argument('-r', '--dry-run', action='store_true',
                                    help='Do not delete selected objects')
+        self._aparser.add_argument('-f', '--full', action='store_true',
+                                   help='Walk all backups again and verify persisted marks')
+        self._aparser.add_argument('-w', '--workers', type=int,
+                                   help='Number of workers (default from storage configuration)')
 
     def run(self, args, config, storage, remotes):
-        count, size = gc(storage, delete=not args.dry_run)
+        start = time.time()
+        count, size = gc(storage, delete=not args.dry_run, full=args.full, workers=args.workers)
         if count:
             printer.p('Done. Deleted {n} objects, total size: {s}', n=count, s=humanize.naturalsize(size, binary=True))
         else:
             printer.p('Done. Nothing to delete.')
+        peak_memory = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        printer.p('Duration: {t:.1f}s, peak memory: {m}', t=time.time() - start,
+                  m=humanize.naturalsize(peak_memory, binary=True))
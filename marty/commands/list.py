@@ -1,10 +1,14 @@
-import arrow
+import collections
+
+import humanize
 
 from marty.commands import Command
+from marty.datastructures import parse_date
+from marty.operations.refcounts import exclusive_size
 from marty.printer import printer
 
 
-DATE_FORMAT = 'DD/MM/YYYY HH:mm:ss'
+DATE_FORMAT = '%d/%m/%Y %H:%M:%S'
 ORDERS = {'name': lambda x: x[0],
           'date': lambda x: x[1].start_date,
           'duration': lambda x: x[1].duration}
@@ -19,15 +23,25 @@ class List(Command):
 
     def prepare(self):
         self._aparser.add_argument('remote', nargs='?')
-        self._aparser.add_argument('-s', '--since', type=arrow.get)
-        self._aparser.add_argument('-u', '--until', type=arrow.get)
+        self._aparser.add_argument('-s', '--since', type=parse_date)
+        self._aparser.add_argument('-u', '--until', type=parse_date)
         self._aparser.add_argument('-o', '--order', choices=ORDERS, default='name')
+        self._aparser.add_argument('-x', '--exclusive', action='store_true',
+                                   help='Show the space only used by each backup (needs the refcount index)')
 
     def run(self, args, config, storage, remotes):
         table_lines = [('', '<b>NAME</b>', '<b>START DATE</b>', '<b>DURATION</b>')]
 
         pattern = '%s/*' % args.remote if args.remote else None
 
+        if args.exclusive:
+            if storage.refcounts is None:
+                raise RuntimeError('Refcount index is not enabled on this storage')
+            table_lines[0] += ('<b>EXCLUSIVE</b>',)
+            labels = {x: storage.resolve(x) for x in storage.list_labels()}
+            labels_count = collections.Counter(labels.values())
+            listed = []
+
         for label, backup in sorted(storage.list_backups(pattern=pattern,
                                                          since=args.since,
                                                          until=args.until),
@@ -46,12 +60,23 @@ class List(Command):
             else:
                 flags.append('<b>O</b>')
 
-            table_lines.append((''.join(flags),
-                               name,
-                               backup.start_date.format(DATE_FORMAT),
-                               str(backup.duration)))
+            line = (''.join(flags),
+                    name,
+                    backup.start_date.strftime(DATE_FORMAT),
+                    str(backup.duration))
+            if args.exclusive:
+                # Space freed by the removal of all labels of the backup:
+                ref = labels[label]
+                count, size = exclusive_size(storage, [ref] * labels_count[ref])
+                line += (humanize.naturalsize(size, binary=True),)
+                listed.append(ref)
+            table_lines.append(line)
 
         printer.table(table_lines)
+        if args.exclusive:
+            count, size = exclusive_size(storage, listed)
+            printer.p('\nSpace only used by listed backups: {s} ({n} objects)',
+                      s=humanize.naturalsize(size, binary=True), n=count)
         printer.p('\nFlags: <b>P</b> have parent, '
                   '<color fg=red><b>E</b></color> - have errors, '
                   '<b>O</b> orphan backup')
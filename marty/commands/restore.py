@@ -1,6 +1,9 @@
+import humanize
+
 from marty.commands import Command
-from marty.operations.restore import restore
-from marty.operations.objects import get_parent_tree
+from marty.operations.restore import restore, RESTORE_WORKERS, RESTORE_MEMORY
+from marty.operations.objects import get_parent_tree, tree_totals
+from marty.printer import printer
 
 
 class Restore(Command):
@@ -14,6 +17,14 @@ class Restore(Command):
         self._aparser.add_argument('remote')
         self._aparser.add_argument('name')
         self._aparser.add_argument('path', nargs='?', default='/')
+        self._aparser.add_argument('-w', '--workers', type=int, default=RESTORE_WORKERS,
+                                   help='Number of blobs written concurrently (default: %(default)s)')
+        self._aparser.add_argument('-m', '--memory', type=int, default=RESTORE_MEMORY // 1024 ** 2, metavar='MIB',
+                                   help='Maximum size of blobs being written (default: %(default)s)')
+        self._aparser.add_argument('-i', '--incremental', action='store_true',
+                                   help='Skip files having the same size and mtime on the remote')
+        self._aparser.add_argument('-C', '--checksum', action='store_true',
+                                   help='With --incremental, compare checksums of files instead of mtime')
 
     def run(self, args, config, storage, remotes):
         remote = remotes.get(args.remote)
@@ -21,4 +32,10 @@ class Restore(Command):
         backup = storage.get_backup(name)
         tree = storage.get_tree(backup.root)
         tree, parent_path = get_parent_tree(storage, tree, args.path.encode('utf8'))
-        restore(storage, remote, tree, parent_path)
+        if printer.is_verbose:
+            # Totals of trees backuped by older versions are computed by walking them:
+            size, count = tree_totals(storage, tree)
+            printer.verbose('Restoring {c} items, {s}', c=count, s=humanize.naturalsize(size, binary=True))
+        restore(storage, remote, tree, parent_path, workers=args.workers,
+                memory=args.memory * 1024 ** 2, progress=True,
+                incremental=args.incremental, checksum=args.checksum)
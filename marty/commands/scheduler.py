@@ -1,5 +1,5 @@
 from marty.commands import Command
-from marty.operations.scheduler import scheduler
+from marty.operations.scheduler import scheduler, async_scheduler
 
 
 class Scheduler(Command):
@@ -16,4 +16,12 @@ class Scheduler(Command):
                 scheduled_remotes.append(remote)
         workers = config.subsection('scheduler').get('workers')
         loop_interval = config.subsection('scheduler').get('loop_interval')
-        scheduler(storage, scheduled_remotes, workers=workers, loop_interval=loop_interval)
+        gc_interval = config.subsection('scheduler').get('gc_interval')
+        scrub = {x: config.subsection('scheduler').get(x) for x in ('scrub_rate', 'scrub_period', 'scrub_niceness')}
+        if config.subsection('scheduler').get('engine') == 'asyncio':
+            concurrency = config.subsection('scheduler').get('concurrency')
+            async_scheduler(storage, scheduled_remotes, workers=workers, loop_interval=loop_interval,
+                            concurrency=concurrency, gc_interval=gc_interval, **scrub)
+        else:
+            scheduler(storage, scheduled_remotes, workers=workers, loop_interval=loop_interval,
+                      gc_interval=gc_interval, **scrub)
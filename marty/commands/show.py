@@ -32,10 +32,12 @@ class ShowTree(Command):
         name = '%s/%s' % (args.remote, args.name) if args.remote else args.name
         tree = storage.get_tree(name)
         table_lines = [('<b>NAME</b>', '<b>TYPE</b>', '<b>REF</b>', '<b>ATTRIBUTES</b>')]
-        for name, details in sorted(tree.items()):
+        for name, details in tree.items():
             name = '<b>%s</b>' % name.decode('utf-8', 'replace')
             type = details.pop('type', '')
             ref = details.pop('ref', '')
+            if details.pop('data', None) is not None:
+                ref = '(inline)'
             fmt = '<color fg=green>%s</color>:<color fg=cyan>%s</color>'
             attributes = ' '.join(fmt % (k, v) for k, v in sorted(details.items(), key=tree_attr_sorter))
             table_lines.append((name, type, ref, attributes))
@@ -59,8 +61,8 @@ class ShowBackup(Command):
         name = '%s/%s' % (args.remote, args.name) if args.remote else args.name
         backup = storage.get_backup(name)
         printer.p('<b>Date:</b> {s} -> {e} ({d})',
-                  s=backup.start_date.format('DD/MM/YYYY HH:mm:ss'),
-                  e=backup.end_date.format('DD/MM/YYYY HH:mm:ss'),
+                  s=backup.start_date.strftime('%d/%m/%Y %H:%M:%S'),
+                  e=backup.end_date.strftime('%d/%m/%Y %H:%M:%S'),
                   d=backup.duration)
         printer.p('<b>Root:</b> {r}', r=backup.root)
         if backup.parent:
@@ -100,7 +102,7 @@ class RecursivelyShowTree(Command):
         last = False
         next_level = level + (True,)
 
-        for i, (name, item) in enumerate(tree.items()):
+        for i, (name, item) in enumerate(tree.iter_items()):
             if len(tree) == i + 1:
                 last = True
                 next_level = level + (False,)
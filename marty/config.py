@@ -5,7 +5,7 @@ import pkg_resources
 
 from confiture import Confiture
 from confiture.schema import ValidationError
-from confiture.schema.containers import Section, Value, once
+from confiture.schema.containers import Section, Value, Choice, once
 from confiture.schema.types import String, Integer
 
 
@@ -60,6 +60,12 @@ class SchedulerConfig(Section):
 
     workers = Value(Integer(min=1), default=2)
     loop_interval = Value(Integer(min=1), default=60)  # Default: 1mn
+    engine = Choice({'threads': 'threads', 'asyncio': 'asyncio'}, default='threads')
+    concurrency = Value(Integer(min=1), default=100)  # Only used by asyncio engine
+    gc_interval = Value(Integer(min=0), default=0)  # In minutes, 0 disables the gc
+    scrub_rate = Value(Integer(min=0), default=0)  # In bytes/s, 0 disables the scrubbing
+    scrub_period = Value(Integer(min=1), default=30)  # In days
+    scrub_niceness = Value(Integer(min=0, max=19), default=19)
 
 
 class RootMartyConfig(Section):
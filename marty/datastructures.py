@@ -1,11 +1,58 @@
 import io
+import os
+import struct
+import datetime
+import sys
+import mmap
+import array
+import bisect
+import heapq
+import hashlib
 from collections import Counter
+from collections.abc import MutableMapping
 
 import humanize
-import arrow
 import msgpack
 
 
+# Trees larger than this size are lazily decoded:
+LAZY_TREE_SIZE = 1048576
+
+# Type of the items referencing the nodes of a split tree:
+NODE_ITEM_TYPE = 'subtree'
+
+
+# Dates are serialized as a timestamp in microseconds and an UTC offset:
+DATE_EXT_TYPE = 2
+DATE_STRUCT = struct.Struct('>qi')
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def now():
+    """ Returns the current date, in the local timezone.
+    """
+    return datetime.datetime.now(datetime.timezone.utc).astimezone()
+
+
+def parse_date(value):
+    """ Parse a date string into an aware datetime object.
+
+    ISO 8601 dates are parsed natively when possible, arrow is used for
+    other formats.
+    """
+    try:
+        date = datetime.datetime.fromisoformat(value)
+    except (AttributeError, ValueError):
+        import arrow
+        try:
+            date = arrow.get(value).datetime
+        except arrow.parser.ParserError:
+            date = arrow.Arrow.strptime(value, '%Y%m%dT%H:%M:%S.%f').datetime
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return date
+
+
 class MartyObjectDecodeError(RuntimeError):
 
     """ Error occuring when Marty object unserialization fails.
@@ -33,11 +80,18 @@ class Blob(MartyObject):
 
     """ A blob (Binary Large Object).
 
-    This is basically a wrapper around the object file.
+    This is basically a wrapper around the object file. Sparse blobs can
+    provide the list of (offset, length) extents of their data and their
+    size, allowing holes to be skipped without reading them. Local blobs
+    are regular local files which can be copied using kernel-side
+    operations.
     """
 
-    def __init__(self, blob=None):
+    def __init__(self, blob=None, extents=None, size=None, local=False):
         self.blob = blob
+        self.extents = extents
+        self.size = size
+        self.local = local
 
     @classmethod
     def from_file(cls, fileobj):
@@ -58,23 +112,31 @@ class MsgPackMartyObject(MartyObject):
     def msgpack_encoder(value):
         """ Encoder used by msgpack serializer when an object is unknown.
 
-        This hook is basically used to serialize dates in Arrow objects.
+        This hook is basically used to serialize dates, as a timestamp in
+        microseconds and an UTC offset in seconds.
         """
-        if isinstance(value, arrow.Arrow):
-            value = msgpack.ExtType(1, value.isoformat().encode())
+        value = getattr(value, 'datetime', value)  # Arrow objects
+        if isinstance(value, datetime.datetime):
+            if value.tzinfo is None:
+                value = value.astimezone()
+            timestamp = (value - EPOCH) // datetime.timedelta(microseconds=1)
+            offset = value.utcoffset() // datetime.timedelta(seconds=1)
+            value = msgpack.ExtType(DATE_EXT_TYPE, DATE_STRUCT.pack(timestamp, offset))
         return value
 
     @staticmethod
     def msgpack_ext_decoder(code, data):
         """ Decoded used by msgpack deserializer when an ext type is found.
 
-        This hook is basically used to deserialize dates in Arrow objects.
+        This hook is basically used to deserialize dates in datetime objects,
+        either from timestamps or from legacy ISO 8601 strings.
         """
-        if code == 1:
-            try:
-                return arrow.get(data.decode())
-            except arrow.parser.ParserError:
-                return arrow.Arrow.strptime(data.decode(), '%Y%m%dT%H:%M:%S.%f')
+        if code == DATE_EXT_TYPE:
+            timestamp, offset = DATE_STRUCT.unpack(data)
+            date = EPOCH + datetime.timedelta(microseconds=timestamp)
+            return date.astimezone(datetime.timezone(datetime.timedelta(seconds=offset)))
+        elif code == 1:
+            return parse_date(data.decode())
         return msgpack.ExtType(code, data)
 
     @classmethod
@@ -94,11 +156,107 @@ class MsgPackMartyObject(MartyObject):
         return io.BytesIO(msgpack.packb(self.to_msgpack(), use_bin_type=True, default=self.msgpack_encoder))
 
 
-class TreeItem(dict):
+class TreeItem(MutableMapping):
 
-    """ A simple shortcut around a dict object to handle Tree item dicts.
+    """ A compact mapping handling Tree item attributes.
+
+    Well known attributes are stored in slots rather than in a per-item dict,
+    other attributes are stored in an extra dict only created when needed.
     """
 
+    # Well known attributes, sorted to get sorted items without sorting:
+    KNOWN_KEYS = ('atime', 'ctime', 'data', 'filetype', 'gid', 'hardlink', 'link',
+                  'mode', 'mtime', 'ref', 'size', 'tree_count', 'tree_size', 'type', 'uid')
+    _SLOTS = {k: '_' + k for k in KNOWN_KEYS}
+
+    __slots__ = tuple('_' + k for k in KNOWN_KEYS) + ('_extra',)
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        if args or kwargs:
+            self.update(*args, **kwargs)
+
+    @classmethod
+    def from_pairs(cls, pairs):
+        """ Instanciate an item from a list of (key, value) pairs.
+        """
+        item = cls()
+        slots = cls._SLOTS
+        for key, value in pairs:
+            slot = slots.get(key)
+            if slot is None:
+                if item._extra is None:
+                    item._extra = {}
+                item._extra[sys.intern(key)] = value
+            else:
+                setattr(item, slot, value)
+        return item
+
+    def __getitem__(self, key):
+        slot = self._SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+            return self._extra[key]
+        try:
+            return getattr(self, slot)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        slot = self._SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[sys.intern(key)] = value
+        else:
+            setattr(self, slot, value)
+
+    def __delitem__(self, key):
+        slot = self._SLOTS.get(key)
+        if slot is None:
+            if self._extra is None:
+                raise KeyError(key)
+            del self._extra[key]
+        else:
+            try:
+                delattr(self, slot)
+            except AttributeError:
+                raise KeyError(key)
+
+    def __contains__(self, key):
+        slot = self._SLOTS.get(key)
+        if slot is None:
+            return self._extra is not None and key in self._extra
+        return hasattr(self, slot)
+
+    def __iter__(self):
+        for key in self.KNOWN_KEYS:
+            if hasattr(self, self._SLOTS[key]):
+                yield key
+        if self._extra is not None:
+            yield from self._extra
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'TreeItem(%r)' % dict(self.items())
+
+    def get(self, key, default=None):
+        slot = self._SLOTS.get(key)
+        if slot is None:
+            return default if self._extra is None else self._extra.get(key, default)
+        return getattr(self, slot, default)
+
+    def sorted_pairs(self):
+        """ Returns the list of (key, value) attributes pairs sorted by key.
+        """
+        pairs = [(k, getattr(self, s)) for k, s in zip(self.KNOWN_KEYS, self.__slots__) if hasattr(self, s)]
+        if self._extra:
+            pairs = sorted(pairs + list(self._extra.items()))
+        return pairs
+
     @property
     def type(self):
         return self.get('type')
@@ -116,60 +274,337 @@ class Tree(MsgPackMartyObject):
 
     """ A tree.
 
-    A list of items which can reference other Marty objects.
+    A list of items which can reference other Marty objects. Names and items
+    are kept in two parallel lists sorted by name, allowing lookups by
+    bisection and iteration without copy. Items added out of order are
+    sorted at once on the next access.
+
+    Large trees read from a file are lazily decoded: only the names are
+    indexed when the tree is loaded, item details are decoded on access.
     """
 
     def __init__(self, items=None):
-        if items is None:
-            self._items = {}
-        else:
-            self._items = items
+        self._names = []
+        self._details = []
+        self._sorted = True
+        self._raw = None  # Serialized tree, when lazily decoded
+        self._spans = None  # Offsets (start, end) of each item details in raw
+        if items is not None:
+            for name, details in items.items():
+                self.add(name, details)
+
+    @classmethod
+    def from_file(cls, fileobj):
+        try:
+            size = os.fstat(fileobj.fileno()).st_size
+        except (AttributeError, OSError, ValueError):
+            size = None
+        if size is None or size < LAZY_TREE_SIZE:
+            return super(Tree, cls).from_file(fileobj)
+
+        # Objects are never modified in place, mapping them is safe:
+        tree = cls()
+        try:
+            tree._load_index(mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ))
+        except Exception:
+            raise MartyObjectDecodeError('Error while unpacking msgpack object')
+        return tree
+
+    def _load_index(self, raw):
+        """ Index the names of the serialized tree without decoding details.
+        """
+        unpacker = msgpack.Unpacker(raw, encoding='utf8', ext_hook=self.msgpack_ext_decoder)
+        names = []
+        spans = array.array('Q')
+        for _ in range(unpacker.read_array_header()):
+            if unpacker.read_array_header() != 2:
+                raise ValueError('Malformed tree item')
+            names.append(unpacker.unpack())
+            spans.append(unpacker.tell())
+            unpacker.skip()
+            spans.append(unpacker.tell())
+        self._names = names
+        self._details = [None] * len(names)
+        self._raw = raw
+        self._spans = spans
+        # Serialized trees are always sorted, but do not trust the input:
+        if not all(a < b for a, b in zip(names, names[1:])):
+            self._materialize()
+            self._sorted = False
+
+    def _decode(self, index, cache=True):
+        """ Returns the details of the item at index, decoding them if needed.
+        """
+        details = self._details[index]
+        if details is None:
+            start, end = self._spans[index * 2], self._spans[index * 2 + 1]
+            try:
+                parsed = msgpack.unpackb(self._raw[start:end], encoding='utf8',
+                                         ext_hook=self.msgpack_ext_decoder)
+                details = TreeItem.from_pairs(parsed)
+            except Exception:
+                raise MartyObjectDecodeError('Error while reading msgpack object')
+            if cache:
+                self._details[index] = details
+        return details
+
+    def _materialize(self):
+        """ Decode all item details and release the serialized tree.
+        """
+        if self._raw is not None:
+            for index in range(len(self._names)):
+                self._decode(index)
+            self._raw = None
+            self._spans = None
+
+    def _sort(self):
+        """ Sort items by name, keeping the last added item for duplicate names.
+        """
+        names, details = [], []
+        order = sorted(range(len(self._names)), key=self._names.__getitem__)
+        for index in order:
+            name = self._names[index]
+            if names and names[-1] == name:
+                details[-1] = self._details[index]
+            else:
+                names.append(name)
+                details.append(self._details[index])
+        self._names = names
+        self._details = details
+        self._sorted = True
+
+    def _index(self, name):
+        """ Returns the index of the named item or None if not found.
+        """
+        if not self._sorted:
+            self._sort()
+        index = bisect.bisect_left(self._names, name)
+        if index < len(self._names) and self._names[index] == name:
+            return index
+        return None
 
     def __contains__(self, name):
-        return name in self._items
+        return self._index(name) is not None
 
     def __getitem__(self, key):
-        return self._items[key]
+        index = self._index(key)
+        if index is None:
+            raise KeyError(key)
+        return self._decode(index)
 
     def __len__(self):
-        return len(self._items)
+        if not self._sorted:
+            self._sort()
+        return len(self._names)
 
     def names(self):
         """ Returns sorted names of items.
         """
-        return sorted(self._items.keys())
+        if not self._sorted:
+            self._sort()
+        return list(self._names)
 
     def items(self):
-        """ Returns a sorted pair of (name, details) of items.
+        """ Returns a sorted list of (name, details) pairs of items.
+
+        The returned list is a snapshot, so the tree can be modified while
+        iterating on it.
         """
-        return sorted(self._items.items(), key=lambda x: x[0])
+        return list(self.iter_items())
+
+    def iter_items(self):
+        """ Iterate over the sorted (name, details) pairs of items.
+
+        Unlike items, no copy is made so the tree must not be modified while
+        iterating.
+        """
+        if not self._sorted:
+            self._sort()
+        if self._raw is None:
+            return zip(self._names, self._details)
+        return ((name, self._decode(i)) for i, name in enumerate(self._names))
+
+    def stream_items(self):
+        """ Iterate over the sorted (name, details) pairs of items.
+
+        Unlike iter_items, details of lazily decoded trees are not kept once
+        decoded, so a whole tree can be browsed without loading it entirely.
+        """
+        if self._raw is None:
+            return self.iter_items()
+        return ((name, self._decode(i, cache=False)) for i, name in enumerate(self._names))
 
     def from_msgpack(self, parsed):
-        self._items = {k: TreeItem(v) for k, v in parsed}
+        from_pairs = TreeItem.from_pairs
+        self._names = [name for name, _ in parsed]
+        self._details = [from_pairs(details) for _, details in parsed]
+        # Serialized trees are always sorted, but do not trust the input:
+        self._sorted = all(a < b for a, b in zip(self._names, self._names[1:]))
 
     def to_msgpack(self):
-        # Sort all dict and transform them into list in order to get
-        # a distinguished output (same item list always produce the exact
-        # same output once serialized).
-        items = []
-        for name, item in sorted(self._items.items(), key=lambda x: x[0]):
-            item = list(sorted(item.items()))
-            items.append((name, item))
+        # Items are sorted by name and their attributes are transformed into
+        # sorted lists in order to get a distinguished output (same item list
+        # always produce the exact same output once serialized).
+        return [(name, details.sorted_pairs()) for name, details in self.iter_items()]
 
-        return items
+    def totals(self):
+        """ Returns a tuple (size, count) of the total size of blobs and count of
+            items of the tree, recursively.
+
+        Totals of subtrees are read from the tree_size and tree_count
+        attributes of their items, no subtree is loaded.
+        """
+        size = 0
+        count = 0
+        for _, item in self.stream_items():
+            count += 1
+            if item.type == 'blob':
+                size += item.get('size', 0)
+            elif item.type == 'tree':
+                size += item.get('tree_size', 0)
+                count += item.get('tree_count', 0)
+        return size, count
+
+    @property
+    def is_split_index(self):
+        """ True if the tree is the index of a tree split into nodes.
+        """
+        return len(self) > 0 and self._decode(0).type == NODE_ITEM_TYPE
+
+    def node_refs(self):
+        """ Returns refs of the node objects storing the tree, if split.
+        """
+        return []
+
+    def split(self, average, level=0):
+        """ Split the tree into consecutive node trees of average items.
+
+        Boundaries only depend on item names (and on the level of the nodes
+        in the split tree), so adding or removing an item only changes the
+        node containing it.
+        """
+        node = Tree()
+        salt = bytes([level])
+        for name, details in self.iter_items():
+            node._names.append(name)
+            node._details.append(details)
+            digest = hashlib.sha1(salt + name).digest()
+            if int.from_bytes(digest[:4], 'big') % average == 0:
+                yield node
+                node = Tree()
+        if node._names:
+            yield node
 
     def add(self, name, details):
         """ Add a new item in Tree.
         """
-        self._items[name] = TreeItem(details)
+        self._materialize()
+        details = TreeItem(details)
+        if self._sorted and self._names and self._names[-1] >= name:
+            index = self._index(name)
+            if index is not None:
+                self._details[index] = details
+                return
+            self._sorted = False
+        self._names.append(name)
+        self._details.append(details)
 
     def discard(self, name):
         """ Discard an item from the Tree.
         """
-        try:
-            del self._items[name]
-        except KeyError:
-            pass
+        self._materialize()
+        index = self._index(name)
+        if index is not None:
+            del self._names[index]
+            del self._details[index]
+
+
+class SplitTree(Tree):
+
+    """ A large tree split into node trees.
+
+    The index lists the child nodes by the name of their first item, each
+    child is either a regular tree (leaf) or another index. Nodes are loaded
+    on demand using the provided loader (a callable taking a ref and
+    returning the tree) and the whole tree is merged once modified.
+    """
+
+    def __init__(self, index, loader):
+        super(SplitTree, self).__init__()
+        self._loader = loader
+        self._node_names = index.names()
+        self._node_items = [details for _, details in index.iter_items()]
+        self._nodes = {}
+
+    def _node(self, index, cache=True):
+        node = self._nodes.get(index)
+        if node is None:
+            node = self._loader(self._node_items[index].ref)
+            if cache:
+                self._nodes[index] = node
+        return node
+
+    def _find_node(self, name):
+        """ Returns the node which may contain name, or None.
+        """
+        index = bisect.bisect_right(self._node_names, name) - 1
+        return self._node(index) if index >= 0 else None
+
+    def _materialize(self):
+        if self._node_items is not None:
+            for name, details in self.iter_items():
+                self._names.append(name)
+                self._details.append(details)
+            self._node_items = None
+            self._nodes = None
+
+    def __contains__(self, name):
+        if self._node_items is None:
+            return super(SplitTree, self).__contains__(name)
+        node = self._find_node(name)
+        return node is not None and name in node
+
+    def __getitem__(self, key):
+        if self._node_items is None:
+            return super(SplitTree, self).__getitem__(key)
+        node = self._find_node(key)
+        if node is None:
+            raise KeyError(key)
+        return node[key]
+
+    def __len__(self):
+        if self._node_items is None:
+            return super(SplitTree, self).__len__()
+        return sum(x.get('count', 0) for x in self._node_items)
+
+    def names(self):
+        if self._node_items is None:
+            return super(SplitTree, self).names()
+        return [name for name, _ in self.stream_items()]
+
+    def iter_items(self):
+        if self._node_items is None:
+            return super(SplitTree, self).iter_items()
+        return (x for i in range(len(self._node_items)) for x in self._node(i).iter_items())
+
+    def stream_items(self):
+        if self._node_items is None:
+            return super(SplitTree, self).stream_items()
+        return (x for i in range(len(self._node_items)) for x in self._node(i, cache=False).stream_items())
+
+    @property
+    def is_split_index(self):
+        return False  # Nodes are transparently browsed
+
+    def node_refs(self):
+        if self._node_items is None:
+            return []
+        refs = []
+        for index, details in enumerate(self._node_items):
+            refs.append(details.ref)
+            if details.get('level', 0) > 0:
+                refs.extend(self._node(index, cache=False).node_refs())
+        return refs
 
 
 def _size(*values):
@@ -214,12 +649,12 @@ class Backup(MsgPackMartyObject):
     def start(self):
         """ Set the start date of backup to now.
         """
-        self.start_date = arrow.now()
+        self.start_date = now()
 
     def end(self):
         """ Set the end date of backup to now.
         """
-        self.end_date = arrow.now()
+        self.end_date = now()
 
     def from_msgpack(self, parsed):
         self.root = parsed['root']
@@ -273,6 +708,15 @@ class Backup(MsgPackMartyObject):
                   _size(self.stats.get('reused-blob-size', 0),
                         self.stats.get('reused-tree-size', 0))),
                  ('',) * 4,
+                 ('<b>Inlined</b>',
+                  _count(self.stats.get('inline-blob', 0)),
+                  '-',
+                  _count(self.stats.get('inline-blob', 0))),
+                 ('<b>Inlined size</b>',
+                  _size(self.stats.get('inline-blob-size', 0)),
+                  '-',
+                  _size(self.stats.get('inline-blob-size', 0))),
+                 ('',) * 4,
                  ('<b>Skipped</b>',
                   _count(self.stats.get('skipped-blob', 0)),
                   '-',
@@ -285,23 +729,139 @@ class Backup(MsgPackMartyObject):
                  ('<b>Total</b>',
                   _count(self.stats.get('new-blob', 0),
                          self.stats.get('reused-blob', 0),
+                         self.stats.get('inline-blob', 0),
                          self.stats.get('skipped-blob', 0)),
                   _count(self.stats.get('new-tree', 0),
                          self.stats.get('reused-tree', 0)),
                   _count(self.stats.get('new-blob', 0),
                          self.stats.get('reused-blob', 0),
+                         self.stats.get('inline-blob', 0),
                          self.stats.get('skipped-blob', 0),
                          self.stats.get('new-tree', 0),
                          self.stats.get('reused-tree', 0))),
                  ('<b>Total size</b>',
                   _size(self.stats.get('new-blob-size', 0),
                         self.stats.get('reused-blob-size', 0),
+                        self.stats.get('inline-blob-size', 0),
                         self.stats.get('skipped-blob-size', 0)),
                   _size(self.stats.get('new-tree-size', 0),
                         self.stats.get('reused-tree-size', 0)),
                   _size(self.stats.get('new-blob-size', 0),
                         self.stats.get('reused-blob-size', 0),
+                        self.stats.get('inline-blob-size', 0),
                         self.stats.get('skipped-blob-size', 0),
                         self.stats.get('new-tree-size', 0),
                         self.stats.get('reused-tree-size', 0)))]
         return table
+
+
+class MarkSet(object):
+
+    """ A compact set of object digests.
+
+    Digests are stored sorted into a single buffer (20 bytes per digest)
+    instead of one Python object per digest, membership is tested by binary
+    search and iteration is done in ascending order.
+    """
+
+    DIGEST_SIZE = 20
+
+    def __init__(self, data=b''):
+        self._data = data
+
+    @classmethod
+    def merge(cls, *sources):
+        """ Build a set from several iterables of sorted digests.
+        """
+        data = bytearray()
+        last = None
+        for digest in heapq.merge(*sources):
+            if digest != last:
+                data += digest
+                last = digest
+        return cls(data)
+
+    @property
+    def nbytes(self):
+        return len(self._data)
+
+    def __bytes__(self):
+        return bytes(self._data)
+
+    def _digest(self, index):
+        return bytes(self._data[index * self.DIGEST_SIZE:(index + 1) * self.DIGEST_SIZE])
+
+    def __len__(self):
+        return len(self._data) // self.DIGEST_SIZE
+
+    def _bisect(self, digest):
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._digest(middle) < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def __contains__(self, digest):
+        index = self._bisect(digest)
+        return index < len(self) and self._digest(index) == digest
+
+    def __iter__(self):
+        return self.iter_from(b'')
+
+    def iter_from(self, prefix, start=None):
+        """ Iterate in ascending order over digests starting with prefix.
+
+        If provided, iteration starts from the first digest not lower than
+        start (eg: to seek in the middle of a prefix).
+        """
+        for index in range(self._bisect(prefix if start is None else max(prefix, start)), len(self)):
+            digest = self._digest(index)
+            if not digest.startswith(prefix):
+                break
+            yield digest
+
+
+class MarkSetBuilder(object):
+
+    """ Incrementally build a MarkSet from unsorted digests.
+
+    Added digests are buffered in a small set, which is sorted and packed
+    into a MarkSet chunk once it reaches CHUNK_SIZE digests. Chunks of
+    similar sizes are merged together, so there are only a logarithmic number
+    of chunks and memory stays close to DIGEST_SIZE bytes per digest.
+    """
+
+    CHUNK_SIZE = 65536
+
+    def __init__(self):
+        self._pending = set()
+        self._chunks = []
+
+    def _flush(self):
+        if self._pending:
+            self._chunks.append(MarkSet(b''.join(sorted(self._pending))))
+            self._pending = set()
+        while len(self._chunks) > 1 and len(self._chunks[-2]) <= 2 * len(self._chunks[-1]):
+            last = self._chunks.pop()
+            self._chunks[-1] = MarkSet.merge(self._chunks[-1], last)
+
+    def add(self, digest):
+        self._pending.add(digest)
+        if len(self._pending) >= self.CHUNK_SIZE:
+            self._flush()
+
+    def update(self, digests):
+        for digest in digests:
+            self.add(digest)
+
+    def __contains__(self, digest):
+        return digest in self._pending or any(digest in x for x in self._chunks)
+
+    def build(self):
+        """ Get the MarkSet of all added digests.
+        """
+        self._flush()
+        return MarkSet.merge(*self._chunks)
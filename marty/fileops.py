@@ -0,0 +1,213 @@
+""" Low level file operations.
+"""
+
+import os
+import mmap
+import errno
+import hashlib
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+BLOCK_SIZE = 32768
+ZERO_BLOCK = bytes(BLOCK_SIZE)
+HASH_READ_SIZE = 1048576
+
+FICLONE = 0x40049409  # From linux/fs.h
+
+# Errors meaning a kernel-side copy method is not supported for the files:
+UNSUPPORTED_COPY_ERRORS = (errno.EXDEV, errno.EINVAL, errno.ENOSYS, errno.ENOTTY,
+                           errno.EOPNOTSUPP, errno.EBADF, errno.ETXTBSY)
+
+
+def is_zero(buf):
+    """ Return True if the provided buffer only contains zeros.
+    """
+    return buf == ZERO_BLOCK[:len(buf)]
+
+
+def data_extents(fileobj):
+    """ Get the list of (offset, length) data extents of a sparse file.
+
+    Return None if the file object is not a sparse file or if holes can't be
+    detected (SEEK_DATA/SEEK_HOLE not supported by the OS or filesystem).
+    """
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    try:
+        fd = fileobj.fileno()
+        fstat = os.fstat(fd)
+    except (AttributeError, OSError, ValueError):
+        return None
+    if fstat.st_blocks * 512 >= fstat.st_size:
+        return None  # File is not sparse
+
+    extents = []
+    offset = 0
+    try:
+        while offset < fstat.st_size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError as err:
+                if err.errno == errno.ENXIO:
+                    break  # No more data, only a trailing hole
+                raise
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            extents.append((start, end - start))
+            offset = end
+        os.lseek(fd, 0, os.SEEK_SET)
+    except OSError:
+        return None
+    return extents
+
+
+def read_full(fileobj, size):
+    """ Read up to size bytes, only returning less at the end of file.
+    """
+    chunks = []
+    remaining = size
+    while remaining:
+        buf = fileobj.read(remaining)
+        if not buf:
+            break
+        chunks.append(buf)
+        remaining -= len(buf)
+    return b''.join(chunks)
+
+
+def iter_chunks(fileobj, extents=None, size=None, read_size=BLOCK_SIZE):
+    """ Iterate over chunks of the provided file object.
+
+    If data extents are provided, holes are not read and yielded as zero
+    filled chunks instead, the total size of the file must be provided in
+    order to yield the trailing hole.
+    """
+    if extents is None:
+        buf = fileobj.read(read_size)
+        while buf:
+            yield buf
+            buf = fileobj.read(read_size)
+        return
+
+    position = 0
+    for offset, length in list(extents) + [(size, 0)]:
+        # Yield the hole before the extent:
+        while position < offset:
+            chunk_size = min(BLOCK_SIZE, offset - position)
+            yield ZERO_BLOCK[:chunk_size]
+            position += chunk_size
+        # Yield the extent itself:
+        fileobj.seek(offset)
+        while position < offset + length:
+            buf = fileobj.read(min(read_size, offset + length - position))
+            if not buf:
+                raise IOError('Unexpected end of file')
+            yield buf
+            position += len(buf)
+
+
+def copy_sparse(fsrc, fdst, read_size=BLOCK_SIZE):
+    """ Copy fsrc into fdst, keeping holes of zeros.
+
+    The destination must be a seekable file object.
+    """
+    size = 0
+    extents = data_extents(fsrc)
+    if extents is not None:
+        total_size = os.fstat(fsrc.fileno()).st_size
+    else:
+        total_size = None
+    for buf in iter_chunks(fsrc, extents, total_size, read_size):
+        if is_zero(buf):
+            fdst.seek(len(buf), os.SEEK_CUR)
+        else:
+            fdst.write(buf)
+        size += len(buf)
+    fdst.truncate(size)
+    return size
+
+
+def hash_file(fileobj, mapped=False, read_size=HASH_READ_SIZE):
+    """ Compute the SHA-1 of a regular file object.
+
+    If mapped is True, the file is hashed through a memory map. This must
+    only be used on files which can't be truncated meanwhile, as accessing a
+    truncated mapping kills the process (SIGBUS). Otherwise, the file is
+    read into a reused buffer.
+    """
+    fhash = hashlib.sha1()
+    if mapped:
+        fileobj.flush()
+        fd = fileobj.fileno()
+        if os.fstat(fd).st_size:
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped_file:
+                fhash.update(mapped_file)
+    else:
+        buf = bytearray(read_size)
+        view = memoryview(buf)
+        size = fileobj.readinto(buf)
+        while size:
+            fhash.update(view[:size])
+            size = fileobj.readinto(buf)
+    return fhash.hexdigest()
+
+
+def clone_file(fsrc, fdst):
+    """ Copy the regular file fsrc into fdst using kernel-side operations.
+
+    A reflink clone (FICLONE) is tried first, then copy_file_range and
+    sendfile. Return the size of the copied data or None if none of these
+    methods is supported for the provided files.
+    """
+    fdst.flush()
+    src = fsrc.fileno()
+    dst = fdst.fileno()
+    size = os.fstat(src).st_size
+
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(dst, FICLONE, src)
+        except OSError as err:
+            if err.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+        else:
+            return size
+
+    for method in (getattr(os, 'copy_file_range', None), getattr(os, 'sendfile', None)):
+        if method is None:
+            continue
+        offset = 0
+        try:
+            while offset < size:
+                if method is os.sendfile:
+                    copied = os.sendfile(dst, src, offset, size - offset)
+                else:
+                    copied = os.copy_file_range(src, dst, size - offset, offset, offset)
+                if not copied:
+                    break  # Source has been truncated
+                offset += copied
+        except OSError as err:
+            if offset or err.errno not in UNSUPPORTED_COPY_ERRORS:
+                raise
+        else:
+            os.lseek(dst, offset, os.SEEK_SET)
+            return offset
+
+    return None
+
+
+def copy_file(fsrc, fdst, local=False):
+    """ Copy fsrc into fdst.
+
+    If local is True, fsrc is a regular local file and kernel-side copy
+    methods are tried before to copy data through userspace. Holes of sparse
+    files are kept in any case.
+    """
+    if local and data_extents(fsrc) is None:
+        size = clone_file(fsrc, fdst)
+        if size is not None:
+            return size
+    return copy_sparse(fsrc, fdst)
@@ -2,20 +2,23 @@
 """
 
 import os
+import asyncio
 import collections
 
 from marty.datastructures import Backup, Tree
+from marty.remotemethods import RemoteOperationError, MARTY_EXCLUDE
+from marty.operations.labels import set_label
 from marty.printer import printer
 
 
-MARTY_EXCLUDE = b'.marty-exclude'
-
-
-def create_backup(storage, remote, parent=None):
+def create_backup(storage, remote, parent=None, labels=()):
     """ Create a new backup of provided remote and return its backup object.
 
-    .. warning:: Do not forget to add a label on returned backup to avoid its
-       removal by the garbage collector.
+    Provided labels are set on the backup before the session protecting its
+    objects from the garbage collector is closed.
+
+    .. warning:: Without labels, the returned backup may be removed by the
+       garbage collector.
     """
 
     if parent:
@@ -29,21 +32,194 @@ def create_backup(storage, remote, parent=None):
 
     backup = Backup(parent=parent_ref)
 
-    with backup, remote:
-        backup.errors, backup.stats, backup.root = walk_and_ingest_remote(remote, storage, parent=parent_root)
-    ref, size, stored_size = storage.ingest(backup)
+    # The session protects objects of the running backup from the gc:
+    session = storage.open_session([parent_ref] if parent_ref else [])
+    try:
+        with backup, remote:
+            if remote.sequential:
+                backup.errors, backup.stats, backup.root = ingest_remote_stream(remote, storage)
+            else:
+                backup.errors, backup.stats, backup.root = walk_and_ingest_remote(remote, storage, parent=parent_root)
+        ref, size, stored_size = storage.ingest(backup)
+        for label in labels:
+            set_label(storage, label, ref)
+    finally:
+        storage.close_session(session)
     return ref, backup
 
 
-def walk_and_ingest_remote(remote, storage, path=b'/', parent=None):
+def _inline(item, blob, stats):
+    """ Store the blob data inline into the tree item, updating stats.
+
+    Return False if the blob is actually larger than its announced size.
+    """
+    with blob.to_file() as fblob:
+        data = fblob.read(item['size'] + 1)
+    if len(data) > item['size']:
+        return False
+    item['data'] = data
+    stats['inline-blob'] += 1
+    stats['inline-blob-size'] += len(data)
+    return True
+
+
+def _skip_blob(storage, item, parent_item, stats):
+    """ Reuse the content of the unchanged parent item, updating stats.
+    """
+    if 'data' in parent_item:
+        item['data'] = parent_item['data']
+        stats['skipped-blob-size'] += len(item['data'])
+    else:
+        item.ref = parent_item.ref
+        stats['skipped-blob-size'] += storage.size(item.ref)
+    stats['skipped-blob'] += 1
+    return 'SKIP'
+
+
+def _reuse_blob(storage, item, stats):
+    """ Reuse the object of the item ref if it exists, updating stats.
+
+    Reused objects are touched to protect them from a concurrent gc. Return
+    None if the object does not exist.
+    """
+    if not storage.touch(item.ref):
+        return None
+    stats['reused-blob'] += 1
+    stats['reused-blob-size'] += storage.size(item.ref)
+    return 'REUSE'
+
+
+def _ingest_blob(storage, item, blob, stats):
+    """ Ingest a blob into the storage, updating the item and stats.
+
+    The item may be a plain dict (eg: items of sequential remotes).
+    """
+    item['ref'], size, stored_size = storage.ingest(blob)
+    if 'size' not in item:
+        item['size'] = size  # Size only known once ingested (eg: command outputs)
+    if stored_size:
+        stats['new-blob'] += 1
+        stats['new-blob-size'] += size
+        stats['new-blob-stored-size'] += stored_size
+        return 'NEW'
+    else:
+        stats['reused-blob'] += 1
+        stats['reused-blob-size'] += size
+        return 'REUSE'
+
+
+def _walk_error(errors, tree, filename, fullname, kind, err):
+    """ Record an error on an item, which is discarded from its tree.
+    """
+    errors[fullname] = str(err)
+    printer.verbose('{kind}: <b>{path}</b> <color fg=red><b>Error:</b> '
+                    '{error}</color>', kind=kind, path=fullname.decode('utf-8', 'replace'), error=err)
+    tree.discard(filename)
+
+
+def _ingest_tree(storage, tree, stats, path, tree_item=None):
+    """ Ingest a tree into the storage, updating stats.
+
+    If provided, the tree_item of the tree in its parent is updated with the
+    totals (tree_size and tree_count) of the tree.
+    """
+    stats['total-tree'] += 1
+    tree_ref, size, stored_size = storage.ingest_tree(tree)
+    if stored_size:
+        stats['new-tree'] += 1
+        stats['new-tree-size'] += size
+        stats['new-tree-stored-size'] += stored_size
+        action = 'NEW'
+    else:
+        stats['reused-tree'] += 1
+        stats['reused-tree-size'] += size
+        action = 'REUSED'
+    printer.verbose('Tree: <b>{path}</b> {action}', path=path.decode('utf-8', 'replace'), action=action)
+    if tree_item is not None:
+        tree_item['tree_size'], tree_item['tree_count'] = tree.totals()
+    return tree_ref
+
+
+def ingest_remote_stream(remote, storage):
+    """ Ingest a sequential remote into provided storage in a single pass.
+
+    Blobs are ingested as they come, trees are built in memory and ingested
+    at the end, deepest first. Returns the same tuple (errors, stats,
+    tree_ref) than walk_and_ingest_remote.
+    """
+    errors = {}
+    stats = collections.Counter()
+    trees = {b'/': Tree()}
+    inline_threshold = storage.inline_threshold
+
+    def get_parent_tree(path):
+        """ Get the tree of path parent, implicitly creating missing ones.
+        """
+        dirname, basename = os.path.split(path)
+        if dirname not in trees:
+            get_parent_tree(dirname).add(basename, {'type': 'tree', 'filetype': 'directory'})
+            trees[dirname] = Tree()
+        return trees[dirname]
+
+    for path, item, blob in remote.iter_stream():
+        path = os.path.normpath(os.path.join(b'/', path))
+        if path == b'/' or not remote.policy.included(path):
+            continue  # Skip excluded paths
+        tree = get_parent_tree(path)
+        filename = os.path.basename(path)
+        if item is None:
+            _walk_error(errors, tree, filename, path, 'Item', blob)
+            continue
+        elif item.get('type') == 'tree':
+            trees.setdefault(path, Tree())
+        elif item.get('type') == 'blob':
+            stats['total-blob'] += 1
+            if blob is None and 'data' in item:
+                stats['inline-blob'] += 1
+                stats['inline-blob-size'] += len(item['data'])
+                action = 'INLINE'
+            elif blob is None:
+                stats['reused-blob'] += 1
+                stats['reused-blob-size'] += storage.size(item['ref'])
+                action = 'REUSE'
+            elif item.get('size', inline_threshold) < inline_threshold:
+                with blob.to_file() as fblob:
+                    item['data'] = fblob.read()
+                stats['inline-blob'] += 1
+                stats['inline-blob-size'] += len(item['data'])
+                action = 'INLINE'
+            else:
+                try:
+                    action = _ingest_blob(storage, item, blob, stats)
+                except Exception as err:
+                    _walk_error(errors, tree, filename, path, 'Blob', err)
+                    continue
+            printer.verbose('Blob: <b>{path}</b> {action}', path=path.decode('utf-8', 'replace'), action=action)
+        tree.add(filename, item)
+
+    # Ingest trees, deepest first to know refs of subtrees:
+    for path in sorted(trees, key=lambda x: x.rstrip(b'/').count(b'/'), reverse=True):
+        tree_ref = _ingest_tree(storage, trees[path], stats, path)
+        if path != b'/':
+            dirname, basename = os.path.split(path)
+            item = trees[dirname][basename]
+            item.ref = tree_ref
+            item['tree_size'], item['tree_count'] = trees[path].totals()
+
+    return errors, stats, tree_ref
+
+
+def walk_and_ingest_remote(remote, storage, path=b'/', parent=None, tree_item=None):
     """ Recursively walk the remote, ingesting data into provided storage.
 
     Returns a tuple (errors, stats, tree_ref) where errors is a dict of errors
     by filename, stats a dictionnary of statistics and tree_ref the reference
-    on the top level tree.
+    on the top level tree. If provided, the tree_item of the walked tree in
+    its parent is updated with the totals (tree_size and tree_count) of the tree.
     """
     errors = {}
     stats = collections.Counter()
+    inline_threshold = storage.inline_threshold
     tree = remote.get_tree(path)
 
     # Handle remotely excluded directories:
@@ -58,41 +234,25 @@ def walk_and_ingest_remote(remote, storage, path=b'/', parent=None):
             continue
         parent_item = parent[filename] if parent is not None and filename in parent else None
         if item.type == 'blob':
+            stats['total-blob'] += 1
             try:
-                stats['total-blob'] += 1
                 # Check if the item has changed since last backup:
                 if parent_item is not None and not remote.newer(item, parent_item):
-                    item.ref = parent_item.ref
-                    stats['skipped-blob'] += 1
-                    stats['skipped-blob-size'] += storage.size(item.ref)
-                    action = 'SKIP'
+                    action = _skip_blob(storage, item, parent_item, stats)
+                elif (item.get('size', inline_threshold) < inline_threshold and
+                      _inline(item, remote.get_blob(fullname), stats)):
+                    action = 'INLINE'  # Small blobs are stored inline in the tree item
                 else:
                     # Blob items are ingested into the storage if it do not reused already
                     item.ref = remote.checksum(fullname)
-                    if item.ref is None or not storage.exists(item.ref):
-                        blob = remote.get_blob(fullname)
-                        item.ref, size, stored_size = storage.ingest(blob)
-                        if stored_size:
-                            stats['new-blob'] += 1
-                            stats['new-blob-size'] += size
-                            stats['new-blob-stored-size'] += stored_size
-                            action = 'NEW'
-                        else:
-                            stats['reused-blob'] += 1
-                            stats['reused-blob-size'] += size
-                            action = 'REUSE'
-                    else:
-                        stats['reused-blob'] += 1
-                        stats['reused-blob-size'] += storage.size(item.ref)
-                        action = 'REUSE'
-
+                    action = item.ref is not None and _reuse_blob(storage, item, stats)
+                    if not action:
+                        action = _ingest_blob(storage, item, remote.get_blob(fullname), stats)
                 printer.verbose('Blob: <b>{path}</b> {action}', path=fullname.decode('utf-8', 'replace'), action=action)
             except Exception as err:
-                errors[fullname] = str(err)
-                printer.verbose('Blob: <b>{path}</b> <color fg=red><b>Error:</b> '
-                                '{error}</color>', path=fullname.decode('utf-8', 'replace'), error=err)
-                tree.discard(filename)
-                raise
+                _walk_error(errors, tree, filename, fullname, 'Blob', err)
+                if not isinstance(err, RemoteOperationError):
+                    raise
 
         elif item.type == 'tree':
             # Tree items are recursively browsed:
@@ -104,27 +264,121 @@ def walk_and_ingest_remote(remote, storage, path=b'/', parent=None):
                 child_errors, child_stats, item.ref = walk_and_ingest_remote(remote,
                                                                              storage,
                                                                              fullname,
-                                                                             parent_object)
+                                                                             parent_object,
+                                                                             item)
             except Exception as err:
-                errors[fullname] = str(err)
-                printer.verbose('Tree: <b>{path}</b> <color fg=red><b>Error:</b> '
-                                '{error}</color>', path=fullname.decode('utf-8', 'replace'), error=err)
-                tree.discard(filename)
+                _walk_error(errors, tree, filename, fullname, 'Tree', err)
             else:
                 errors.update(child_errors)
                 stats.update(child_stats)
 
     # Ingest the tree into the storage:
-    stats['total-tree'] += 1
-    tree_ref, size, stored_size = storage.ingest(tree)
-    if stored_size:
-        stats['new-tree'] += 1
-        stats['new-tree-size'] += size
-        stats['new-tree-stored-size'] += stored_size
-        action = 'NEW'
+    tree_ref = _ingest_tree(storage, tree, stats, path, tree_item)
+    return errors, stats, tree_ref
+
+
+async def async_create_backup(storage, remote, executor=None, parent=None, labels=()):
+    """ Asyncio flavor of create_backup.
+
+    The remote must be an AsyncRemoteMethod, storage operations are run into
+    the provided executor (or the default executor of the event loop).
+    """
+
+    loop = asyncio.get_event_loop()
+    parent_root = None
+
+    if parent:
+        parent_ref = await loop.run_in_executor(executor, storage.resolve, parent)
+        parent_backup = await loop.run_in_executor(executor, storage.get_backup, parent_ref)
+        if parent_backup:
+            parent_root = await loop.run_in_executor(executor, storage.get_tree, parent_backup.root)
     else:
-        stats['reused-tree'] += 1
-        stats['reused-tree-size'] += size
-        action = 'REUSED'
-    printer.verbose('Tree: <b>{path}</b> {action}', path=path.decode('utf-8', 'replace'), action=action)
+        parent_ref = None
+
+    backup = Backup(parent=parent_ref)
+
+    session = await loop.run_in_executor(executor, storage.open_session, [parent_ref] if parent_ref else [])
+    try:
+        backup.start()
+        try:
+            async with remote:
+                if remote.sequential:
+                    walk = loop.run_in_executor(executor, ingest_remote_stream, remote.remote, storage)
+                else:
+                    walk = async_walk_and_ingest_remote(remote, storage, executor, parent=parent_root)
+                backup.errors, backup.stats, backup.root = await walk
+        finally:
+            backup.end()
+        ref, size, stored_size = await loop.run_in_executor(executor, storage.ingest, backup)
+        for label in labels:
+            await loop.run_in_executor(executor, set_label, storage, label, ref)
+    finally:
+        await loop.run_in_executor(executor, storage.close_session, session)
+    return ref, backup
+
+
+async def async_walk_and_ingest_remote(remote, storage, executor=None, path=b'/', parent=None, tree_item=None):
+    """ Asyncio flavor of walk_and_ingest_remote.
+    """
+    loop = asyncio.get_event_loop()
+    errors = {}
+    stats = collections.Counter()
+    inline_threshold = storage.inline_threshold
+    tree = await remote.get_tree(path)
+
+    # Handle remotely excluded directories:
+    if MARTY_EXCLUDE in tree:
+        tree = Tree()
+
+    for filename, item in tree.items():
+        fullname = os.path.join(path, filename)
+        if not remote.policy.included(fullname):
+            # Skip excluded paths
+            tree.discard(filename)
+            continue
+        parent_item = parent[filename] if parent is not None and filename in parent else None
+        if item.type == 'blob':
+            stats['total-blob'] += 1
+            try:
+                # Check if the item has changed since last backup:
+                if parent_item is not None and not remote.newer(item, parent_item):
+                    action = await loop.run_in_executor(executor, _skip_blob, storage, item, parent_item, stats)
+                elif (item.get('size', inline_threshold) < inline_threshold and
+                      await loop.run_in_executor(executor, _inline, item, await remote.get_blob(fullname), stats)):
+                    action = 'INLINE'  # Small blobs are stored inline in the tree item
+                else:
+                    # Blob items are ingested into the storage if it do not reused already
+                    item.ref = await remote.checksum(fullname)
+                    action = item.ref is not None and await loop.run_in_executor(executor, _reuse_blob,
+                                                                                 storage, item, stats)
+                    if not action:
+                        blob = await remote.get_blob(fullname)
+                        action = await loop.run_in_executor(executor, _ingest_blob, storage, item, blob, stats)
+                printer.verbose('Blob: <b>{path}</b> {action}', path=fullname.decode('utf-8', 'replace'), action=action)
+            except Exception as err:
+                _walk_error(errors, tree, filename, fullname, 'Blob', err)
+                if not isinstance(err, RemoteOperationError):
+                    raise
+
+        elif item.type == 'tree':
+            # Tree items are recursively browsed:
+            if parent_item is not None and parent_item.type == 'tree' and parent_item.ref is not None:
+                parent_object = await loop.run_in_executor(executor, storage.get_tree, parent_item.ref)
+            else:
+                parent_object = None
+            try:
+                child_errors, child_stats, item.ref = await async_walk_and_ingest_remote(remote,
+                                                                                         storage,
+                                                                                         executor,
+                                                                                         fullname,
+                                                                                         parent_object,
+                                                                                         item)
+            except Exception as err:
+                _walk_error(errors, tree, filename, fullname, 'Tree', err)
+            else:
+                errors.update(child_errors)
+                stats.update(child_stats)
+
+    # Ingest the tree into the storage:
+    tree_ref = await loop.run_in_executor(executor, _ingest_tree, storage, tree, stats, path, tree_item)
     return errors, stats, tree_ref
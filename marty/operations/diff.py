@@ -0,0 +1,76 @@
+""" Comparison of trees and backups.
+"""
+
+import os
+
+
+# Attributes defining the content of an item:
+CONTENT_ATTRS = ('type', 'filetype', 'ref', 'data', 'link')
+
+# Attributes ignored when comparing metadata of items:
+IGNORED_ATTRS = CONTENT_ATTRS + ('atime', 'hardlink', 'tree_size', 'tree_count')
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+METADATA = 'metadata'
+
+
+def _metadata(item):
+    return {k: v for k, v in item.items() if k not in IGNORED_ATTRS}
+
+
+def diff_items(old, new):
+    """ Compare two items and return the kind of change (or None).
+
+    Trees with different refs are considered as modified, their content
+    has to be compared to know what actually changed.
+    """
+    if any(old.get(x) != new.get(x) for x in CONTENT_ATTRS):
+        return MODIFIED
+    elif _metadata(old) != _metadata(new):
+        return METADATA
+    else:
+        return None
+
+
+def diff_trees(storage, old, new, prefix=b'/'):
+    """ Recursively compare two trees on the provided storage.
+
+    Yield (change, path, old_item, new_item) tuples where change is one of
+    ADDED, REMOVED, MODIFIED or METADATA. Subtrees with the same ref are
+    identical and are not browsed, so the cost of the comparison only
+    depends on the changed area. Added and removed directories are reported
+    without their content.
+    """
+    old_items = old.stream_items()
+    new_items = new.stream_items()
+    old_name, old_item = next(old_items, (None, None))
+    new_name, new_item = next(new_items, (None, None))
+
+    while old_name is not None or new_name is not None:
+        if new_name is None or (old_name is not None and old_name < new_name):
+            yield REMOVED, os.path.join(prefix, old_name), old_item, None
+            old_name, old_item = next(old_items, (None, None))
+        elif old_name is None or new_name < old_name:
+            yield ADDED, os.path.join(prefix, new_name), None, new_item
+            new_name, new_item = next(new_items, (None, None))
+        else:
+            fullname = os.path.join(prefix, new_name)
+            change = diff_items(old_item, new_item)
+            if change == MODIFIED and old_item.type == new_item.type == 'tree':
+                # Only report metadata of the directory itself, and compare
+                # its content:
+                if _metadata(old_item) != _metadata(new_item):
+                    yield METADATA, fullname, old_item, new_item
+                if old_item.ref is not None and new_item.ref is not None:
+                    yield from diff_trees(storage,
+                                          storage.get_tree(old_item.ref),
+                                          storage.get_tree(new_item.ref),
+                                          fullname)
+                else:
+                    yield MODIFIED, fullname, old_item, new_item
+            elif change is not None:
+                yield change, fullname, old_item, new_item
+            old_name, old_item = next(old_items, (None, None))
+            new_name, new_item = next(new_items, (None, None))
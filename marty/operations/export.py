@@ -1,10 +1,10 @@
 import os
 import tarfile
-import shutil
 import functools
 
 import humanize
 
+from marty.fileops import copy_file
 from marty.operations.objects import walk_tree
 from marty.printer import printer
 
@@ -18,14 +18,25 @@ def export_tar(tree, storage, output, compression=None):
     if compression in ('gz', 'bz2', 'xz'):
         mode += ':' + compression
 
+    hardlinks = {}  # hardlink group -> exported name
+
     with tarfile.open(output, mode) as tar:
         for fullname, item in walk_tree(storage, tree):
             payload = None
             info = tarfile.TarInfo()
             info.name = fullname.decode('utf-8', 'ignore')
 
-            if item.type == 'blob':
-                payload = storage.get_blob(item.ref).blob
+            if item.type == 'blob' and item.get('hardlink') in hardlinks:
+                info.type = tarfile.LNKTYPE
+                info.linkname = hardlinks[item['hardlink']]
+                printer.verbose('Adding to {out}: <b>{fn}</b> (hardlink to {link})',
+                                out=output,
+                                fn=fullname.decode('utf-8', errors='ignore'),
+                                link=info.linkname)
+            elif item.type == 'blob':
+                if 'hardlink' in item:
+                    hardlinks[item['hardlink']] = info.name
+                payload = storage.get_item_blob(item).blob
                 info.type = tarfile.REGTYPE
                 info.size = item['size']
                 printer.verbose('Adding to {out}: <b>{fn}</b> ({size})',
@@ -55,10 +66,9 @@ def export_tar(tree, storage, output, compression=None):
                     continue  # Ignore unknown file types
 
             # Set optional attributes:
-            info.mode = item.get('mode')
-            info.uid = item.get('uid')
-            info.gid = item.get('gid')
-            info.mtime = item.get('mtime')
+            for attr in ('mode', 'uid', 'gid', 'mtime'):
+                if item.get(attr) is not None:
+                    setattr(info, attr, item[attr])
 
             # Add the item into the tar file:
             tar.addfile(info, payload)
@@ -69,14 +79,23 @@ def export_directory(tree, storage, output):
     """
 
     os.mkdir(output)
+    hardlinks = {}  # hardlink group -> exported filename
 
     for fullname, item in walk_tree(storage, tree):
         outfullname = os.path.join(output.encode('utf-8'), fullname.lstrip(b'/'))
 
-        if item.type == 'blob':
-            blob = storage.get_blob(item.ref).blob
+        if item.type == 'blob' and item.get('hardlink') in hardlinks:
+            os.link(hardlinks[item['hardlink']], outfullname)
+            printer.verbose('Exporting to {out}: <b>{fn}</b> (hardlink)',
+                            out=output,
+                            fn=fullname.decode('utf-8', errors='replace'))
+            continue  # Attributes are shared with the first link
+        elif item.type == 'blob':
+            if 'hardlink' in item:
+                hardlinks[item['hardlink']] = outfullname
+            blob = storage.get_item_blob(item)
             with open(outfullname, 'wb') as fout:
-                shutil.copyfileobj(blob, fout)
+                copy_file(blob.blob, fout, local=blob.local)
             printer.verbose('Exporting to {out}: <b>{fn}</b> ({size})',
                             out=output,
                             fn=fullname.decode('utf-8', errors='replace'),
@@ -42,7 +42,7 @@ class MartyFSHandler(llfuse.Operations):
         return inode
 
     def _get_blob(self, item):
-        return self.storage.get_blob(item['ref'])
+        return self.storage.get_item_blob(item)
 
     def getattr(self, inode, ctx=None):
         attrs = self.inodes.get(inode)
@@ -63,8 +63,10 @@ class MartyFSHandler(llfuse.Operations):
         entry = llfuse.EntryAttributes()
         entry.st_mode = mode_filetype | attrs.get('mode', MartyFSHandler.DEFAULT_MODE)
 
-        if attrs.get('type') == 'blob' and 'ref' in attrs:
-            entry.st_size = self.storage.size(attrs['ref'])
+        if attrs.get('type') == 'blob' and ('ref' in attrs or 'data' in attrs):
+            entry.st_size = self.storage.item_size(attrs)
+        elif attrs.get('type') == 'tree':
+            entry.st_size = attrs.get('tree_size', 0)  # Total size of the directory
         else:
             entry.st_size = 0
 
@@ -87,11 +89,12 @@ class MartyFSHandler(llfuse.Operations):
         elif name not in attrs['tree']:
             raise llfuse.FUSEError(errno.ENOENT)
 
-        if 'inode' not in attrs['tree'][name]:
-            inode = self._register_item(attrs['tree'][name])
-            attrs['tree'][name]['inode'] = inode
+        item = attrs['tree'][name]
+        if 'inode' not in item:
+            inode = self._register_item(item)
+            item['inode'] = inode
 
-        return self.getattr(attrs['tree'][name]['inode'])
+        return self.getattr(item['inode'])
 
     def opendir(self, inode, ctx):
         return inode
@@ -104,7 +107,7 @@ class MartyFSHandler(llfuse.Operations):
         elif attrs['type'] != 'tree':
             raise llfuse.FUSEError(errno.ENOENT)
 
-        for i, (name, item) in enumerate(attrs['tree'].items()):
+        for i, (name, item) in enumerate(attrs['tree'].iter_items()):
             if offset > i:
                 continue
 
@@ -0,0 +1,75 @@
+""" Operations on labels, maintaining the refcount index.
+"""
+
+from marty.operations.objects import gc_cutoff
+from marty.operations.refcounts import (add_refs, remove_refs, ensure_refcounts, invalidate_refcounts,
+                                        RefcountIndexError)
+
+
+def reclaim(storage, freed):
+    """ Delete objects not referenced anymore, as returned by remove_refs.
+
+    Objects possibly used by running backups are kept, they will be
+    collected by the next gc. Return the (count, size) of deleted objects.
+    """
+    cutoff, roots = gc_cutoff(storage)
+    sizes = dict(freed)
+    if roots & set(sizes):
+        return 0, 0  # A running backup reuses objects of a removed backup
+    deleted = storage.delete_many([x for x in sizes if storage.exists(x)], before=cutoff)
+    return len(deleted), sum(sizes[x] for x in deleted)
+
+
+def set_label(storage, name, ref):
+    """ Set a label on the provided backup ref.
+
+    Objects of the backup previously pointed by the label are reclaimed if
+    not referenced anymore. The label is only written once the refcount
+    index is updated, the index is invalidated if writing it fails.
+    """
+    index = storage.refcounts
+    if index is None:
+        storage.set_label(name, ref)
+        return
+    ensure_refcounts(storage)
+    try:
+        with index.transaction():
+            old_ref = storage.read_label(name)
+            add_refs(storage, index, [ref])
+            freed = remove_refs(storage, index, [old_ref]) if old_ref else []
+    except RefcountIndexError as err:
+        invalidate_refcounts(storage, err)
+        freed = []  # Unreferenced objects will be collected by the next gc
+    try:
+        storage.set_label(name, ref)
+    except BaseException:
+        invalidate_refcounts(storage, 'unable to set label %s' % name)
+        raise
+    reclaim(storage, freed)
+
+
+def delete_label(storage, name):
+    """ Delete a label.
+
+    If the refcount index is enabled, objects of the backup which are not
+    referenced anymore are immediately reclaimed. Return the (count, size)
+    of deleted objects.
+    """
+    index = storage.refcounts
+    if index is None:
+        storage.delete_label(name)
+        return 0, 0
+    ensure_refcounts(storage)
+    try:
+        with index.transaction():
+            ref = storage.read_label(name)
+            freed = remove_refs(storage, index, [ref]) if ref else []
+    except RefcountIndexError as err:
+        invalidate_refcounts(storage, err)
+        freed = []
+    try:
+        storage.delete_label(name)
+    except BaseException:
+        invalidate_refcounts(storage, 'unable to delete label %s' % name)
+        raise
+    return reclaim(storage, freed)
@@ -2,88 +2,568 @@
 """
 
 import os
-import hashlib
+import time
+import struct
+import functools
+import collections
+import itertools
+import concurrent.futures
 
-from marty.datastructures import Tree
+import humanize
+
+from marty.datastructures import Tree, MarkSet, MarkSetBuilder
 from marty.printer import printer
+from marty.operations.refcounts import verify_refcounts
+
+
+MARKS_READ_SIZE = MarkSet.DIGEST_SIZE * 51200
+MARKS_MERGE_FANIN = 16
+MARKS_MAX_DELTA_DEPTH = 16
+MARKS_DELTA_HEADER = struct.Struct('>4s20sB')  # magic, parent digest, depth
+MARKS_DELTA_MAGIC = b'MKD1'
+GC_DELETE_BATCH_SIZE = 1024
+CHECK_LOG_BATCH_SIZE = 1024
+FSCK_BATCH_SIZE = 1024
+SCRUB_POSITION_KEY = 'scrub-position'
+SCRUB_FLUSH_INTERVAL = 60  # seconds
+SCRUB_IDLE_INTERVAL = 3600  # seconds
 
 
 def walk_tree(storage, tree, prefix=b'/'):
     """ Recursively walk a tree on the provided storage.
     """
 
-    for name, item in tree.items():
+    for name, item in tree.stream_items():
         fullname = os.path.join(prefix, name)
         yield (fullname, item)
         if item.type == 'tree':
             yield from walk_tree(storage, storage.get_tree(item.ref), fullname)
 
 
-def gc_walk_used(storage):
-    """ Get the list of known objects.
+def _tree_refs(storage, ref):
+    """ Get a tuple (objects, trees) of refs referenced by a tree.
+
+    Where objects are the refs of blobs and nodes of the tree, and trees the
+    refs of its subtrees.
     """
+    tree = storage.get_tree(ref)
+    objects = list(tree.node_refs())
+    trees = []
+    for name, item in tree.stream_items():
+        if item.ref:
+            if item.type == 'blob':
+                objects.append(item.ref)
+            elif item.type == 'tree':
+                trees.append(item.ref)
+    return objects, trees
 
-    known_objects = set()
 
-    def _walker(ref):
-        if int(ref, 16) not in known_objects:
-            # Add the tree ref in list of known objects:
-            known_objects.add(int(ref, 16))
+def walk_used(storage, ref, executor=None, known=None):
+    """ Get the MarkSet of digests of objects reachable from the provided backup.
 
-            # Get the tree to browse it:
-            tree = storage.get_tree(ref)
-            for name, item in tree.items():
-                if item.ref:
-                    if item.type == 'blob':
-                        known_objects.add(int(item.ref, 16))
-                    elif item.type == 'tree':
-                        _walker(item.ref)
+    Trees are walked level by level, if an executor is provided trees of
+    a level are fetched and decoded concurrently. If provided, the known
+    MarkSet (the marks of another backup) is used to prune the walk: trees
+    in it are not walked and only objects not in it are returned.
+    """
 
-    for label in storage.list_labels():
-        ref = storage.resolve(label)
-        known_objects.add(int(ref, 16))
-        backup = storage.get_backup(ref)
-        _walker(backup.root)
+    known = MarkSet() if known is None else known
+    backup = storage.get_backup(ref)
+    marks = MarkSetBuilder()
+    level = []
+    for digest in (bytes.fromhex(ref), bytes.fromhex(backup.root)):
+        if digest not in known:
+            marks.add(digest)
+    if bytes.fromhex(backup.root) not in known:
+        level.append(backup.root)
+    mapper = map if executor is None else executor.map
+
+    while level:
+        next_level = []
+        for objects, trees in mapper(functools.partial(_tree_refs, storage), level):
+            marks.update(x for x in (bytes.fromhex(x) for x in objects) if x not in known)
+            for tree_ref in trees:
+                digest = bytes.fromhex(tree_ref)
+                if digest not in known and digest not in marks:
+                    marks.add(digest)
+                    next_level.append(tree_ref)
+        level = next_level
+
+    return marks.build()
+
+
+def read_marks_header(storage, ref):
+    """ Get a tuple (parent, depth) describing persisted marks of a backup.
+
+    Marks are either full (parent is None and depth 0), or a delta holding
+    objects not in the marks of the parent backup, depth being the length
+    of the chain of deltas. Return None if the backup has no valid marks.
+    """
+    fmarks = storage.open_marks(ref)
+    if fmarks is None:
+        return None
+    with fmarks:
+        header = fmarks.read(MARKS_DELTA_HEADER.size)
+        fmarks.seek(0, os.SEEK_END)
+        size = fmarks.tell()
+    if size % MarkSet.DIGEST_SIZE == 0:
+        return None, 0  # Full marks are bare digests
+    magic, parent, depth = MARKS_DELTA_HEADER.unpack(header)
+    if magic != MARKS_DELTA_MAGIC or (size - MARKS_DELTA_HEADER.size) % MarkSet.DIGEST_SIZE:
+        return None
+    return parent.hex(), depth
+
+
+def iter_marks(storage, ref, read_size=MARKS_READ_SIZE, offset=0):
+    """ Iterate over the sorted digests of persisted marks of a backup,
+        starting at the provided offset (after the header of deltas).
+
+    Marks are read by chunks, the file being reopened for each chunk so
+    marks of many backups can be iterated simultaneously.
+    """
+    while True:
+        with storage.open_marks(ref) as fmarks:
+            fmarks.seek(offset)
+            buf = fmarks.read(read_size)
+        if not buf:
+            break
+        offset += len(buf)
+        for index in range(0, len(buf), MarkSet.DIGEST_SIZE):
+            yield buf[index:index + MarkSet.DIGEST_SIZE]
+
+
+def merge_marks(storage, refs, headers):
+    """ Get the MarkSet of the union of persisted marks of provided backups.
+
+    Marks are merged MARKS_MERGE_FANIN files at a time, so the number of
+    files read simultaneously does not grow with the number of backups.
+    """
+    known = MarkSet()
+    refs = sorted(refs)
+    for index in range(0, len(refs), MARKS_MERGE_FANIN):
+        known = MarkSet.merge(known, *(iter_marks(storage, x, offset=0 if headers[x][0] is None
+                                                  else MARKS_DELTA_HEADER.size)
+                                       for x in refs[index:index + MARKS_MERGE_FANIN]))
+    return known
+
+
+def gc_walk_used(storage, full=False, executor=None, roots=()):
+    """ Get the MarkSet of digests of known objects.
+
+    Objects reachable from each labelled backup (and from provided roots)
+    are persisted as marks into the storage, so only backups labelled since
+    the last run are walked. Marks of a backup are persisted as a delta
+    against the marks of its parent when available: only trees not in the
+    parent marks are walked, and the marks of a backup are the union of the
+    chain of deltas up to full marks. Objects removed since the parent are
+    thus still marked until full marks are written again, at most every
+    MARKS_MAX_DELTA_DEPTH backups. If full is True, all backups are walked
+    again, persisted marks are verified and replaced by exact full marks.
+    """
 
-    return known_objects
+    headers = {}  # ref -> (parent, depth) of persisted marks
 
+    def header(ref):
+        if ref not in headers:
+            headers[ref] = read_marks_header(storage, ref)
+        return headers[ref]
 
-def gc_iter_unused(storage):
-    """ Iterate over the list of unused objects.
+    def chain(ref):
+        """ Get the list of refs of marks of a backup, or None if broken.
+        """
+        refs = []
+        while ref is not None:
+            if header(ref) is None or ref in refs:
+                return None
+            refs.append(ref)
+            ref = header(ref)[0]
+        return refs
+
+    def walk(ref):
+        parent = storage.get_backup(ref).parent
+        parent_chain = chain(parent) if parent is not None and not full else None
+        if parent_chain is not None and header(parent)[1] < MARKS_MAX_DELTA_DEPTH:
+            printer.verbose('Walking backup {ref} (delta from {parent})', ref=ref, parent=parent)
+            depth = header(parent)[1] + 1
+            marks = walk_used(storage, ref, executor, known=merge_marks(storage, parent_chain, headers))
+            storage.write_marks(ref, MARKS_DELTA_HEADER.pack(MARKS_DELTA_MAGIC, bytes.fromhex(parent), depth) +
+                                bytes(marks))
+            headers[ref] = (parent, depth)
+            return [ref] + parent_chain
+        printer.verbose('Walking backup {ref}', ref=ref)
+        marks = walk_used(storage, ref, executor)
+        previous_chain = chain(ref) if full else None
+        if previous_chain is not None:
+            previous = merge_marks(storage, previous_chain, headers)
+            if any(x not in previous for x in marks):
+                printer.p('<color fg=yellow>Warning:</color> marks of backup {ref} were invalid', ref=ref)
+        storage.write_marks(ref, bytes(marks))
+        headers[ref] = (None, 0)
+        return [ref]
+
+    backups = set()
+    needed = set()
+
+    for ref in itertools.chain((storage.resolve(x) for x in storage.list_labels()), roots):
+        if ref in backups:
+            continue
+        backups.add(ref)
+        refs = None if full else chain(ref)
+        needed.update(walk(ref) if refs is None else refs)
+
+    # Drop marks which are not needed by labelled backups anymore:
+    for ref in list(storage.list_marks()):
+        if ref not in needed:
+            storage.delete_marks(ref)
+
+    return merge_marks(storage, needed, headers)
+
+
+def gc_iter_unused(storage, known_objects, prefix=''):
+    """ Iterate over the list of unused objects having refs starting with prefix.
+
+    The sorted list of objects of the storage is merged with the sorted
+    known objects.
     """
-    known_objects = gc_walk_used(storage)
-    for ref in storage.list():
-        if int(ref, 16) not in known_objects:
+    known = known_objects.iter_from(bytes.fromhex(prefix[:len(prefix) // 2 * 2]),
+                                    start=bytes.fromhex(prefix + '0' * (len(prefix) % 2)))
+    digest = next(known, None)
+    for ref in storage.list_sorted(prefix):
+        object_digest = bytes.fromhex(ref)
+        while digest is not None and digest < object_digest:
+            digest = next(known, None)
+        if digest != object_digest:
             yield ref
 
 
-def gc(storage, delete=True):
-    """ Delete unused objects.
+def _gc_sweep(storage, known_objects, prefix, cutoff, delete=True):
+    """ Delete unused objects having refs starting with prefix, by batches.
+
+    Objects ingested or reused since the cutoff timestamp are kept.
     """
     count = 0
     size = 0
-    for ref in gc_iter_unused(storage):
+    batch = {}
+
+    def flush():
+        deleted = storage.delete_many(list(batch), before=cutoff) if delete else batch
+        return len(deleted), sum(batch[x] for x in deleted)
+
+    for ref in gc_iter_unused(storage, known_objects, prefix):
+        if storage.mtime(ref) >= cutoff:
+            continue  # Possibly used by a running backup
         printer.verbose('Removing object {ref}', ref=ref)
-        size += storage.size(ref)
+        batch[ref] = storage.size(ref)
+        if len(batch) >= GC_DELETE_BATCH_SIZE:
+            batch_count, batch_size = flush()
+            count += batch_count
+            size += batch_size
+            batch = {}
+    if batch:
+        batch_count, batch_size = flush()
+        count += batch_count
+        size += batch_size
+    return count, size
+
+
+def gc_cutoff(storage):
+    """ Get a tuple (cutoff, roots) protecting objects of running backups.
+
+    Objects ingested or reused since the cutoff timestamp must be kept, as
+    well as objects reachable from the roots (parents of running backups).
+    """
+    cutoff = time.time() - storage.gc_grace_period
+    roots = set()
+    for session, session_start, session_roots in storage.list_sessions():
+        cutoff = min(cutoff, session_start)
+        roots.update(session_roots)
+    return cutoff, roots
+
+
+def gc(storage, delete=True, full=False, workers=None):
+    """ Delete unused objects.
+
+    Trees are fetched concurrently by the provided number of workers
+    (default is taken from the storage configuration) while marking used
+    objects, then the pool is swept by shards (refs prefixes) in parallel.
+
+    Backups may run meanwhile: objects ingested or reused since the start of
+    the oldest running backup or during the storage grace period are kept,
+    as well as objects reachable from the parents of running backups.
+
+    The refcount index (if enabled) is verified against the marks on full
+    runs, as incremental marks may include objects not used anymore.
+    """
+    if workers is None:
+        workers = storage.gc_workers
+    cutoff, roots = gc_cutoff(storage)
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        start = time.time()
+        known_objects = gc_walk_used(storage, full=full, executor=executor, roots=roots)
+        printer.verbose('Marked {n} objects in {t:.1f}s ({s} of marks)', n=len(known_objects),
+                        t=time.time() - start, s=humanize.naturalsize(known_objects.nbytes, binary=True))
+        if storage.refcounts is not None and not roots and full:
+            # Marks are exactly those of labelled backups, use them to verify the index
+            verify_refcounts(storage, known_objects)
+
+        start = time.time()
+        sweep = functools.partial(_gc_sweep, storage, known_objects, cutoff=cutoff, delete=delete)
+        results = list(executor.map(sweep, storage.list_shards()))
+        printer.verbose('Swept pool in {t:.1f}s', t=time.time() - start)
+
+    return sum(x[0] for x in results), sum(x[1] for x in results)
+
+
+def check_candidates(storage, since=None, prefix='', corrupted=True):
+    """ Iterate over refs of objects to check having refs starting with
+        prefix, in ascending order.
+
+    Objects verified since the provided timestamp are skipped, all objects
+    are selected if since is None. Objects found corrupted by their last
+    check are selected if corrupted is True, and skipped otherwise. The log
+    of deleted objects is dropped.
+    """
+    prefix_digest = bytes.fromhex(prefix)
+    log = itertools.takewhile(lambda x: x[0].startswith(prefix_digest),
+                              storage.checklog.iter_from(prefix_digest))
+    digest, checked, valid = next(log, (None, None, None))
+    deleted = []
+    for ref in storage.list_sorted(prefix):
+        object_digest = bytes.fromhex(ref)
+        while digest is not None and digest < object_digest:
+            deleted.append(digest.hex())
+            digest, checked, valid = next(log, (None, None, None))
+        if digest != object_digest:
+            yield ref  # Never checked
+            continue
+        if not valid:
+            if corrupted:
+                yield ref
+        elif since is None or checked < since:
+            yield ref
+        digest, checked, valid = next(log, (None, None, None))
+    while digest is not None:
+        deleted.append(digest.hex())
+        digest, checked, valid = next(log, (None, None, None))
+    storage.checklog.delete(deleted)
+
+
+def check_plan(storage, since=None):
+    """ Get the (count, size) of objects to check.
+    """
+    count = 0
+    size = 0
+    for ref in check_candidates(storage, since):
+        try:
+            size += storage.size(ref)
+        except FileNotFoundError:
+            continue  # Deleted meanwhile
         count += 1
-        if delete:
-            storage.delete(ref)
     return count, size
 
 
-def check(storage, read_size=4096):
-    """ Check hash of all objects in the pool.
+def _check_object(storage, ref):
+    try:
+        return ref, storage.size(ref), storage.verify(ref)
+    except FileNotFoundError:
+        return ref, 0, None  # Deleted meanwhile
+
+
+def check(storage, since=None, workers=None, time_budget=None, size_budget=None):
+    """ Check hash of objects in the pool.
+
+    Objects selected by check_candidates are hashed concurrently by the
+    provided number of workers (default is taken from the storage
+    configuration), hashing and reading files releasing the GIL. The check
+    stops once the time budget (seconds) or size budget (bytes) is reached.
+    Results are persisted into the check log of the storage.
+
+    Yield a tuple (ref, size, valid) for each checked object.
+    """
+    if workers is None:
+        workers = storage.check_workers
+    start = time.time()
+    checked_size = 0
+    results = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        candidates = check_candidates(storage, since)
+        try:
+            while True:
+                # Keep workers busy, unless the budget is reached:
+                while len(pending) < workers * 2:
+                    if time_budget is not None and time.time() - start >= time_budget:
+                        break
+                    if size_budget is not None and checked_size >= size_budget:
+                        break
+                    ref = next(candidates, None)
+                    if ref is None:
+                        break
+                    try:
+                        checked_size += storage.size(ref)
+                    except FileNotFoundError:
+                        continue  # Deleted meanwhile
+                    pending.append(executor.submit(_check_object, storage, ref))
+                if not pending:
+                    break
+                ref, size, valid = pending.popleft().result()
+                if valid is None:
+                    continue
+                results[ref] = (time.time(), valid)
+                if len(results) >= CHECK_LOG_BATCH_SIZE:
+                    storage.checklog.update(results)
+                    results = {}
+                yield ref, size, valid
+        finally:
+            for future in pending:
+                future.cancel()
+            storage.checklog.update(results)
+
+
+def scrub(storage, period, rate, active=None):
+    """ Continuously check objects not verified for period seconds.
+
+    Objects are checked one at a time in ascending order of refs, and the
+    position is persisted into the check log so scrubbing resumes where it
+    stopped. Objects already known as corrupted are not checked again.
+    Reads are limited to rate bytes per second, and scrubbing waits while
+    the active event (if provided) is not set.
+
+    Yield a tuple (ref, size, valid) for each checked object.
+    """
+    checklog = storage.checklog
+    position = checklog.get_state(SCRUB_POSITION_KEY, '')
+    results = {}
+    last_flush = time.time()
+    while True:
+        cycle_count = 0
+        for shard in ['%02x' % x for x in range(int(position[:2] or '00', 16), 256)]:
+            for ref in check_candidates(storage, time.time() - period, shard, corrupted=False):
+                if ref <= position:
+                    continue  # Already checked before a restart
+                if active is not None and not active.is_set():
+                    active.wait()
+                start = time.time()
+                ref, size, valid = _check_object(storage, ref)
+                position = ref
+                if valid is not None:
+                    results[ref] = (time.time(), valid)
+                    cycle_count += 1
+                if len(results) >= CHECK_LOG_BATCH_SIZE or time.time() - last_flush >= SCRUB_FLUSH_INTERVAL:
+                    checklog.update(results)
+                    checklog.set_state(SCRUB_POSITION_KEY, position)
+                    results = {}
+                    last_flush = time.time()
+                if valid is not None:
+                    yield ref, size, valid
+                # Limit the rate of reads:
+                time.sleep(max(0, start + size / rate - time.time()))
+        position = ''
+        checklog.update(results)
+        checklog.set_state(SCRUB_POSITION_KEY, position)
+        results = {}
+        if not cycle_count:
+            time.sleep(SCRUB_IDLE_INTERVAL)  # Everything has been recently checked
+
+
+def _fsck_objects(storage, refs, verify, executor):
+    """ Get the error (or None) of each of the provided refs.
+    """
+    def check_object(ref):
+        try:
+            if not storage.exists(ref):
+                return 'missing object'
+            elif verify and not storage.verify(ref):
+                return 'corrupted object'
+        except OSError as err:
+            return str(err)
+        return None
+    return list(executor.map(check_object, refs))
+
+
+def fsck_tree(storage, ref, executor, verify=False, clean=None, damaged=None):
+    """ Check that a tree and all objects it references exist and decode.
+
+    Return the list of (path, ref, error) of damaged items, with paths
+    relative to the tree. Items are streamed, referenced blobs are checked by
+    batches using the provided executor, and also hashed if verify is True.
+    The clean MarkSetBuilder (of digests) and damaged dict (ref -> errors) of
+    already checked trees are used and updated, so subtrees shared by
+    several backups are only checked once.
     """
-    for ref in storage.list():
-        printer.verbose('Checking {ref}', ref=ref, err=True)
-        hasher = hashlib.sha1()
-        fobject = storage.open(ref)
-        buf = fobject.read(read_size)
-        while buf:
-            hasher.update(buf)
-            buf = fobject.read(read_size)
-        if hasher.hexdigest() != ref:
-            printer.p(ref)
+    clean = MarkSetBuilder() if clean is None else clean
+    damaged = {} if damaged is None else damaged
+    digest = bytes.fromhex(ref)
+    if digest in clean:
+        return []
+    elif ref in damaged:
+        return damaged[ref]
+
+    errors = []
+    blobs = []
+
+    def check_blobs():
+        for (name, blob_ref), error in zip(blobs, _fsck_objects(storage, [x[1] for x in blobs], verify, executor)):
+            if error is not None:
+                errors.append((name, blob_ref, error))
+        del blobs[:]
+
+    error, = _fsck_objects(storage, [ref], verify, executor)
+    if error is not None:
+        errors.append((b'', ref, error))
+    else:
+        try:
+            tree = storage.get_tree(ref)
+            nodes = list(tree.node_refs())
+            for node_ref, error in zip(nodes, _fsck_objects(storage, nodes, verify, executor)):
+                if error is not None:
+                    errors.append((b'', node_ref, error))
+            items = tree.stream_items() if not errors else ()
+            for name, item in items:
+                if item.type == 'blob' and item.ref:
+                    blobs.append((name, item.ref))
+                    if len(blobs) >= FSCK_BATCH_SIZE:
+                        check_blobs()
+                elif item.type == 'tree' and item.ref:
+                    for path, child_ref, error in fsck_tree(storage, item.ref, executor, verify, clean, damaged):
+                        errors.append((os.path.join(name, path) if path else name, child_ref, error))
+        except Exception as err:
+            errors.append((b'', ref, 'undecodable tree: %s' % err))
+        check_blobs()
+
+    if errors:
+        damaged[ref] = errors
+    else:
+        clean.add(digest)
+    return errors
+
+
+def fsck(storage, verify=False, workers=None):
+    """ Check that objects reachable from labelled backups exist and decode.
+
+    Yield a tuple (labels, path, ref, error) for each damaged item, where
+    labels are the labels of the damaged backup. Objects are checked by the
+    provided number of workers (default is taken from the storage
+    configuration).
+    """
+    if workers is None:
+        workers = storage.check_workers
+    backups = collections.defaultdict(list)
+    for label in storage.list_labels():
+        backups[storage.resolve(label)].append(label)
+
+    clean = MarkSetBuilder()
+    damaged = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        for ref, labels in sorted(backups.items()):
+            printer.verbose('Checking backup {ref}', ref=ref)
+            try:
+                backup = storage.get_backup(ref)
+            except Exception as err:
+                yield labels, b'', ref, 'undecodable backup: %s' % err
+                continue
+            for path, item_ref, error in fsck_tree(storage, backup.root, executor, verify, clean, damaged):
+                yield labels, os.path.join(b'/', path), item_ref, error
 
 
 def get_parent_tree(storage, root_tree, path):
@@ -122,3 +602,34 @@ def get_parent_tree(storage, root_tree, path):
         return tree, b'/'.join(components[:-1])
     else:
         return root_tree, b''
+
+
+def item_totals(storage, item):
+    """ Get a tuple (size, count) of the total size of blobs and count of items
+        of an item, including itself.
+
+    Totals stored into tree items are used when available, subtrees
+    without them (backuped by older versions) are walked.
+    """
+    if item.type == 'blob':
+        return item.get('size', 0), 1
+    elif item.type == 'tree' and 'tree_size' in item and 'tree_count' in item:
+        return item['tree_size'], item['tree_count'] + 1
+    elif item.type == 'tree' and item.ref:
+        size, count = tree_totals(storage, storage.get_tree(item.ref))
+        return size, count + 1
+    else:
+        return 0, 1
+
+
+def tree_totals(storage, tree):
+    """ Get a tuple (size, count) of the total size of blobs and count of items
+        of a tree, recursively.
+    """
+    size = 0
+    count = 0
+    for _, item in tree.stream_items():
+        item_size, item_count = item_totals(storage, item)
+        size += item_size
+        count += item_count
+    return size, count
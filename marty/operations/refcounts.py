@@ -0,0 +1,156 @@
+""" Maintenance of the reference count index of objects.
+
+Labelled backups are counted once per label, trees and blobs once per
+distinct referencing tree or backup. The content of a tree is only counted
+when the tree becomes referenced, so shared subtrees are counted once.
+"""
+
+import itertools
+
+from marty.printer import printer
+
+
+BACKUP = 'backup'
+TREE = 'tree'
+OBJECT = 'object'
+
+
+class RefcountIndexError(RuntimeError):
+    pass
+
+
+def _children(storage, ref, kind):
+    """ Get the list of (ref, kind) directly referenced by an object.
+    """
+    if not storage.exists(ref):
+        return []  # Missing objects are reported by check
+    elif kind == BACKUP:
+        return [(storage.get_backup(ref).root, TREE)]
+    elif kind == TREE:
+        tree = storage.get_tree(ref)
+        children = [(x, OBJECT) for x in tree.node_refs()]
+        for name, item in tree.stream_items():
+            if item.ref:
+                children.append((item.ref, TREE if item.type == 'tree' else OBJECT))
+        return children
+    else:
+        return []
+
+
+def _size(storage, ref):
+    try:
+        return storage.size(ref)
+    except FileNotFoundError:
+        return 0
+
+
+def _incref(storage, index, refs, changes):
+    """ Increment the count of provided backups in changes.
+    """
+    stack = [(x, BACKUP) for x in refs]
+    while stack:
+        ref, kind = stack.pop()
+        count, size = changes.get(ref) or index.get(ref) or (0, 0)
+        if not count:
+            size = _size(storage, ref)
+            stack.extend(_children(storage, ref, kind))
+        changes[ref] = (count + 1, size)
+    return changes
+
+
+def _decref(storage, index, refs, changes):
+    """ Decrement the count of provided backups in changes.
+
+    Return the list of refs of objects which are not referenced anymore.
+    """
+    freed = []
+    stack = [(x, BACKUP) for x in refs]
+    while stack:
+        ref, kind = stack.pop()
+        count, size = changes.get(ref) or index.get(ref) or (0, 0)
+        if not count:
+            raise RefcountIndexError('Object %s is missing from the refcount index' % ref)
+        changes[ref] = (count - 1, size)
+        if count == 1:
+            freed.append(ref)
+            stack.extend(_children(storage, ref, kind))
+    return freed
+
+
+def add_refs(storage, index, refs):
+    """ Count a new reference to each of the provided backups.
+
+    Must be called in a transaction of the index.
+    """
+    index.update(_incref(storage, index, refs, {}))
+
+
+def remove_refs(storage, index, refs):
+    """ Remove a reference to each of the provided backups.
+
+    Must be called in a transaction of the index. Return the list of
+    (ref, size) of objects which are not referenced anymore.
+    """
+    changes = {}
+    freed = _decref(storage, index, refs, changes)
+    index.update(changes)
+    return [(x, changes[x][1]) for x in freed]
+
+
+def exclusive_size(storage, refs):
+    """ Get the (count, size) of objects only referenced by provided backups.
+
+    Refs are the backups pointed by removed labels, a backup having
+    several labels must be provided once per label. This is the space which
+    would be freed by the removal of these labels.
+    """
+    changes = {}
+    freed = _decref(storage, ensure_refcounts(storage), refs, changes)
+    return len(freed), sum(changes[x][1] for x in freed)
+
+
+def rebuild_refcounts(storage):
+    """ Rebuild the refcount index from the labels of the storage.
+    """
+    index = storage.refcounts
+    with index.transaction():
+        index.clear()
+        for label in storage.list_labels():
+            add_refs(storage, index, [storage.resolve(label)])
+        index.set_built(True)
+
+
+def ensure_refcounts(storage):
+    """ Get the refcount index of the storage, building it if needed (eg: on
+        first use with a storage created without it).
+    """
+    index = storage.refcounts
+    if not index.is_built():
+        printer.verbose('Building the refcount index')
+        rebuild_refcounts(storage)
+    return index
+
+
+def invalidate_refcounts(storage, reason):
+    """ Mark the refcount index as invalid, it will be rebuilt on next use.
+    """
+    printer.p('<color fg=yellow>Warning:</color> {reason}, the refcount index will be rebuilt', reason=reason)
+    storage.refcounts.set_built(False)
+
+
+def verify_refcounts(storage, known_objects):
+    """ Check referenced objects of the refcount index against the MarkSet of
+        objects reachable from labelled backups.
+
+    The index is rebuilt if they differ.
+    """
+    index = storage.refcounts
+    if not index.is_built():
+        rebuild_refcounts(storage)
+        return True
+    with index.transaction():
+        mismatch = any(x != y for x, y in itertools.zip_longest(index, known_objects))
+    if mismatch:
+        printer.p('<color fg=yellow>Warning:</color> refcount index is invalid, rebuilding it')
+        rebuild_refcounts(storage)
+    return not mismatch
@@ -2,27 +2,187 @@
 """
 
 import os
+import time
+import hashlib
+import collections
+import concurrent.futures
 
+import humanize
+
+from marty.datastructures import Tree
+from marty.remotemethods import RemoteOperationError
 from marty.printer import printer
-from marty.operations.objects import walk_tree
 
 
-def restore(storage, remote, tree, prefix=b'/'):
+RESTORE_WORKERS = 4
+RESTORE_MEMORY = 64 * 1024 * 1024
+PROGRESS_INTERVAL = 10  # seconds
+
+
+def _put_item_metadata(remote, item, fullname):
+    path, name = os.path.split(fullname)
+    tree = Tree()
+    tree.add(name, item)
+    remote.put_metadata(tree, path)
+
+
+def _put_blob(storage, remote, item, fullname):
+    printer.verbose('Blob: <b>{path}</b>', path=fullname.decode('utf-8', 'replace'))
+    remote.put_blob(storage.get_item_blob(item), fullname)
+    # Put metadata right away, so an interrupted restore can be resumed:
+    _put_item_metadata(remote, item, fullname)
+    return item.get('size', 0)
+
+
+def _put_tree_metadata(remote, tree, path):
+    """ Put metadata of items of the tree which are not blobs.
+
+    Metadata of blobs are put once each blob is written (or skipped), so
+    only directories and other items are left for the final pass.
+    """
+    others = Tree()
+    for name, item in tree.iter_items():
+        if item.type != 'blob':
+            others.add(name, item)
+    remote.put_metadata(others, path)
+
+
+def _get_target_tree(remote, path):
+    """ Get the tree already existing on the remote at path (if any).
+    """
+    try:
+        return remote.get_tree(path)
+    except (RemoteOperationError, OSError):
+        return Tree()
+
+
+def identical_blob(remote, item, target_item, fullname, checksum=False):
+    """ Check if a blob item is already restored on the remote.
+
+    The target item (from the remote tree) must have the same size and must
+    not be newer or older than the item, according to the remote. If
+    checksum is True, the remote checksum of the file is compared instead.
+    """
+    if target_item is None or target_item.get('filetype') != 'regular':
+        return False
+    elif target_item.get('size') != item.get('size'):
+        return False
+    elif checksum:
+        if 'data' in item:
+            ref = hashlib.sha1(item['data']).hexdigest()
+        else:
+            ref = item.ref
+        return remote.checksum(fullname) == ref
+    else:
+        return not remote.newer(item, target_item) and not remote.newer(target_item, item)
+
+
+def restore(storage, remote, tree, prefix=b'/', workers=RESTORE_WORKERS, memory=RESTORE_MEMORY, progress=False,
+            incremental=False, checksum=False):
     """ Restore a tree object into the remote.
+
+    The restoration is done in three steps: all trees are put first
+    (creating directories and empty files), then blobs are written
+    concurrently by the provided number of workers, each with its metadata,
+    and metadata of other items are finally put, deepest trees first. Blobs being written are limited to
+    the provided memory budget (bytes, according to their size) to bound
+    the data buffered by remotes. If progress is True, the progress is
+    periodically printed.
+
+    If incremental is True, blobs already identical on the remote (see
+    identical_blob) are skipped.
+
+    Return a tuple (count, size, skipped) of the count and size of written
+    blobs and the count of skipped ones.
     """
 
     prefix = os.path.join(b'/', prefix)
+    hardlinks = {}  # hardlink group -> (restored path, future of its blob)
+    restored_trees = []  # (path, ref) of restored subtrees, in walk order
+    pending = collections.deque()  # (future, size) of blobs being written
+    pending_size = 0
+    count = 0
+    size = 0
+    skipped = 0
+    start = last_progress = time.time()
+
+    def wait_pending():
+        nonlocal pending_size, count, size, last_progress
+        future, blob_size = pending.popleft()
+        pending_size -= blob_size
+        size += future.result()
+        count += 1
+        if progress and time.time() - last_progress >= PROGRESS_INTERVAL:
+            last_progress = time.time()
+            printer.p('Restored {n} blobs, {s} ({r}/s), skipped {k}', n=count,
+                      s=humanize.naturalsize(size, binary=True),
+                      r=humanize.naturalsize(size / (last_progress - start), binary=True), k=skipped, err=True)
+
+    def put_trees(tree, path):
+        printer.verbose('Tree: <b>{path}</b>', path=path.decode('utf-8', 'replace'))
+        remote.put_tree(tree, path)
+        for name, item in tree.stream_items():
+            if item.type == 'tree' and item.ref:
+                fullname = os.path.join(path, name)
+                restored_trees.append((fullname, item.ref))
+                put_trees(storage.get_tree(item.ref), fullname)
+
+    def put_blobs(tree, path):
+        nonlocal pending_size, skipped
+        target = _get_target_tree(remote, path) if incremental else Tree()
+        for name, item in tree.stream_items():
+            if item.type != 'blob':
+                continue
+            fullname = os.path.join(path, name)
+            if 'hardlink' in item:
+                if item['hardlink'] in hardlinks:
+                    source, source_future = hardlinks[item['hardlink']]
+                    if source_future is not None:
+                        source_future.result()
+                    try:
+                        remote.put_hardlink(source, fullname)
+                    except NotImplementedError:
+                        pass  # Fallback on a copy of the blob
+                    else:
+                        continue
+            if incremental and identical_blob(remote, item, target[name] if name in target else None,
+                                              fullname, checksum):
+                printer.verbose('Blob: <b>{path}</b> SKIP', path=fullname.decode('utf-8', 'replace'))
+                if checksum:
+                    _put_item_metadata(remote, item, fullname)  # Only the content was compared
+                skipped += 1
+                if 'hardlink' in item and item['hardlink'] not in hardlinks:
+                    hardlinks[item['hardlink']] = (fullname, None)
+                continue
+            blob_size = item.get('size', 0)
+            while pending and (len(pending) >= workers * 2 or pending_size + blob_size > memory):
+                wait_pending()
+            future = executor.submit(_put_blob, storage, remote, item, fullname)
+            pending.append((future, blob_size))
+            pending_size += blob_size
+            if 'hardlink' in item and item['hardlink'] not in hardlinks:
+                hardlinks[item['hardlink']] = (fullname, future)
+
+    with remote, concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        try:
+            put_trees(tree, prefix)
+            put_blobs(tree, prefix)
+            for path, ref in restored_trees:
+                put_blobs(storage.get_tree(ref), path)
+            while pending:
+                wait_pending()
+        finally:
+            for future, blob_size in pending:
+                future.cancel()
+
+        # Metadata of directories are put once their content is restored:
+        for path, ref in reversed(restored_trees):
+            _put_tree_metadata(remote, storage.get_tree(ref), path)
+        _put_tree_metadata(remote, tree, prefix)
 
-    with remote:
-        remote.put_tree(tree, prefix)
-        printer.verbose('Tree: <b>{path}</b>', path=prefix.decode('utf-8', 'replace'))
-
-        for fullname, item in walk_tree(storage, tree, prefix):
-            if item.type == 'tree':
-                printer.verbose('Tree: <b>{path}</b>', path=fullname.decode('utf-8', 'replace'))
-                tree = storage.get_tree(item.ref)
-                remote.put_tree(tree, fullname)
-            elif item.type == 'blob':
-                printer.verbose('Blob: <b>{path}</b>', path=fullname.decode('utf-8', 'replace'))
-                blob = storage.get_blob(item.ref)
-                remote.put_blob(blob, fullname)
+    duration = time.time() - start
+    if progress:
+        printer.p('Restored {n} blobs, {s} in {d:.1f}s ({r}/s), skipped {k}', n=count,
+                  s=humanize.naturalsize(size, binary=True), d=duration,
+                  r=humanize.naturalsize(size / duration if duration else 0, binary=True), k=skipped, err=True)
+    return count, size, skipped
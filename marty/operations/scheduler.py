@@ -1,46 +1,125 @@
+import os
 import time
+import asyncio
+import threading
 import datetime
 import concurrent.futures
 
-import arrow
-
 from marty.printer import printer
-from marty.operations.backup import create_backup
+from marty.datastructures import now
+from marty.operations.backup import create_backup, async_create_backup
+from marty.operations.objects import gc, scrub
 
 
-def scheduler_task(storage, remote, parent):
-    backup_label = arrow.now().strftime('%Y-%m-%d_%H-%M-%S')
+def scheduler_gc_due(running, last_gc, gc_interval):
+    """ Check if the garbage collector should be run by the scheduler.
+
+    The gc is run in quiet periods (no running backup) once gc_interval
+    minutes have passed since the last run. Backups started meanwhile are
+    safe, the gc keeps objects of running backups.
+    """
+    return bool(gc_interval) and not running and last_gc + gc_interval * 60 < time.time()
+
+
+def lower_thread_priority(niceness):
+    """ Set the niceness of the calling thread.
+
+    On Linux, the I/O priority of a thread is derived from its niceness
+    (unless explicitly set) by the CFQ and BFQ I/O schedulers.
+    """
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), niceness)
+    except (AttributeError, OSError):
+        pass  # Not supported by the platform
+
+
+def scheduler_scrub(storage, scrub_rate, scrub_period, scrub_niceness, active):
+    """ Run the background scrubbing of the storage (in its own thread).
+    """
+    lower_thread_priority(scrub_niceness)
+    try:
+        for ref, size, valid in scrub(storage, scrub_period * 86400, scrub_rate, active):
+            if not valid:
+                printer.p('Scrubbing found a corrupted object: {ref}', ref=ref)
+    except Exception as err:
+        printer.p('Scrubbing failed: {e}', e=err)
+
+
+def start_scheduler_scrub(storage, scrub_rate, scrub_period, scrub_niceness):
+    """ Start the background scrubbing if enabled (scrub_rate is set).
+
+    Return the event to set to let the scrubbing run.
+    """
+    active = threading.Event()
+    if scrub_rate:
+        thread = threading.Thread(target=scheduler_scrub, daemon=True,
+                                  args=(storage, scrub_rate, scrub_period, scrub_niceness, active))
+        thread.start()
+        printer.p('Started background scrubbing at {r} bytes/s', r=scrub_rate)
+    return active
+
+
+def scheduler_gc_done(result):
+    """ Print the result of a gc run by the scheduler.
+    """
+    if result.exception() is not None:
+        printer.p('Garbage collection failed: {e}', e=result.exception())
+    else:
+        count, size = result.result()
+        printer.p('Garbage collection removed {n} objects ({s} bytes)', n=count, s=size)
+
+
+def scheduler_due(storage, remote):
+    """ Check if a new backup of the remote is due.
+
+    Return a tuple (due, parent) where due is True if the remote has not
+    been backuped since its configured interval, and parent the label of the
+    backup to use as parent (or None).
+    """
+    interval = datetime.timedelta(seconds=remote.scheduler['interval'] * 60)
+    parent = '%s/latest' % remote.name
+    backup = storage.get_backup(parent)
+    if backup is None:
+        parent = None
+
+    return backup is None or backup.start_date + interval < now(), parent
+
 
-    ref, backup = create_backup(storage, remote, parent=parent)
+def scheduler_task(storage, remote, parent):
+    backup_label = now().strftime('%Y-%m-%d_%H-%M-%S')
 
-    # Create labels for the new backup:
-    storage.set_label('%s/%s' % (remote.name, backup_label), ref)
-    storage.set_label('%s/latest' % remote.name, ref)
+    ref, backup = create_backup(storage, remote, parent=parent,
+                                labels=['%s/%s' % (remote.name, backup_label), '%s/latest' % remote.name])
 
     return backup
 
 
-def scheduler(storage, remotes, workers=1, loop_interval=10):
+def scheduler(storage, remotes, workers=1, loop_interval=10, gc_interval=0,
+              scrub_rate=0, scrub_period=30, scrub_niceness=19):
     """ Execute the scheduler for the specified remotes.
+
+    If gc_interval is set, the garbage collector is run every gc_interval
+    minutes when no backup is running. If scrub_rate is set, objects not
+    verified for scrub_period days are checked in background at this rate
+    (bytes/s) when no backup or gc is running.
     """
 
     printer.p('Scheduler started for {n} remotes', n=len(remotes))
     running = {}  # remote -> future backup task result
+    running_gc = None
+    last_gc = time.time()
+    scrub_active = start_scheduler_scrub(storage, scrub_rate, scrub_period, scrub_niceness)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=1) as gc_executor:
         while True:
             for remote in remotes:
                 if remote in running:
                     continue  # Ignore still running remotes
 
                 # Check if the remote has been backuped since configured interval:
-                interval = datetime.timedelta(seconds=remote.scheduler['interval'] * 60)
-                parent = '%s/latest' % remote.name
-                backup = storage.get_backup(parent)
-                if backup is None:
-                    parent = None
-
-                if backup is None or backup.start_date + interval < arrow.now():
+                due, parent = scheduler_due(storage, remote)
+                if due:
                     running[remote] = executor.submit(scheduler_task, storage, remote, parent)
                     printer.p('Queued a new backup for {n}', n=remote.name)
 
@@ -57,4 +136,115 @@ def scheduler(storage, remotes, workers=1, loop_interval=10):
 
                     del running[remote]
 
+            # Handle the garbage collection:
+            if running_gc is not None and running_gc.done():
+                scheduler_gc_done(running_gc)
+                running_gc = None
+                last_gc = time.time()
+            if running_gc is None and scheduler_gc_due(running, last_gc, gc_interval):
+                running_gc = gc_executor.submit(gc, storage)
+                printer.p('Started garbage collection')
+
+            # Pause the scrubbing while backups or gc are running:
+            if running or running_gc is not None:
+                scrub_active.clear()
+            else:
+                scrub_active.set()
+
             time.sleep(loop_interval)
+
+
+async def async_scheduler_task(storage, remote, parent, executor, semaphore, remote_executor=None):
+    async with semaphore:
+        backup_label = now().strftime('%Y-%m-%d_%H-%M-%S')
+
+        labels = ['%s/%s' % (remote.name, backup_label), '%s/latest' % remote.name]
+        ref, backup = await async_create_backup(storage, remote.asynchronous(remote_executor or executor), executor,
+                                                parent=parent, labels=labels)
+
+    return backup
+
+
+async def async_scheduler_loop(storage, remotes, executor, concurrency, loop_interval, gc_interval=0,
+                               scrub_active=None, remote_executor=None):
+    """ Main loop of the asyncio scheduler.
+
+    Storage operations are run into the executor, and blocking calls of
+    remotes into the remote_executor (if provided).
+    """
+
+    loop = asyncio.get_event_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    running = {}  # remote -> backup task
+    running_gc = None
+    last_gc = time.time()
+
+    while True:
+        for remote in remotes:
+            if remote in running:
+                continue  # Ignore still running remotes
+
+            # Check if the remote has been backuped since configured interval:
+            due, parent = await loop.run_in_executor(executor, scheduler_due, storage, remote)
+            if due:
+                coro = async_scheduler_task(storage, remote, parent, executor, semaphore, remote_executor)
+                running[remote] = loop.create_task(coro)
+                printer.p('Queued a new backup for {n}', n=remote.name)
+
+        # Handle completed backups:
+        for remote, task in list(running.items()):
+            if task.done():
+                if task.exception() is not None:
+                    printer.p('Backup for {n} failed: {e}', n=remote.name, e=task.exception())
+                else:
+                    backup = task.result()
+                    printer.p('Backup for {n} has been completed in {d} seconds',
+                              n=remote.name,
+                              d=backup.duration.seconds)
+
+                del running[remote]
+
+        # Handle the garbage collection (run in its own thread):
+        if running_gc is not None and running_gc.done():
+            scheduler_gc_done(running_gc)
+            running_gc = None
+            last_gc = time.time()
+        if running_gc is None and scheduler_gc_due(running, last_gc, gc_interval):
+            running_gc = loop.run_in_executor(None, gc, storage)
+            printer.p('Started garbage collection')
+
+        # Pause the scrubbing while backups or gc are running:
+        if scrub_active is not None:
+            if running or running_gc is not None:
+                scrub_active.clear()
+            else:
+                scrub_active.set()
+
+        await asyncio.sleep(loop_interval)
+
+
+def async_scheduler(storage, remotes, workers=1, loop_interval=10, concurrency=100, gc_interval=0,
+                    scrub_rate=0, scrub_period=30, scrub_niceness=19):
+    """ Execute the asyncio scheduler for the specified remotes.
+
+    Up to concurrency backups are run at the same time in a single event
+    loop. Storage operations are offloaded into a pool of workers threads.
+    Remotes with native asyncio support (exec) run in the event loop, other
+    remotes are adapted by running their blocking calls into a distinct pool
+    of up to concurrency threads.
+    """
+
+    printer.p('Scheduler (asyncio) started for {n} remotes', n=len(remotes))
+    scrub_active = start_scheduler_scrub(storage, scrub_rate, scrub_period, scrub_niceness)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as remote_executor:
+        try:
+            loop.run_until_complete(async_scheduler_loop(storage, remotes, executor, concurrency,
+                                                         loop_interval, gc_interval, scrub_active,
+                                                         remote_executor))
+        finally:
+            loop.close()
@@ -174,6 +174,10 @@ class MartyPrinter(object):
     def output(self):
         return self._output
 
+    @property
+    def is_verbose(self):
+        return self._verbose or self._debug
+
     def _print(self, *args, **kwargs):
         sep = kwargs.pop('sep', ' ')
         end = kwargs.pop('end', '\n')
@@ -205,7 +209,7 @@ class MartyPrinter(object):
             self._print(*args, err=True, **kwargs)
 
     def verbose(self, *args, **kwargs):
-        if self._verbose or self._debug:
+        if self.is_verbose:
             self._print(*args, **kwargs)
 
     def p(self, *args, **kwargs):
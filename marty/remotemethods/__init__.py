@@ -1,9 +1,13 @@
 import os
+import re
+import asyncio
 
 from confiture.schema.containers import Section, Value, List
 from confiture.schema.types import String, Integer, Boolean
 
 
+MARTY_EXCLUDE = b'.marty-exclude'
+
 class RemoteOperationError(RuntimeError):
 
     """ Error raised during a remote method operation.
@@ -26,33 +30,55 @@ class DefaultRemoteMethodSchema(Section):
     schedule = SchedulerRemoteMethodSchema()
 
 
-class PathPolicy:
+class PathPolicyNode(object):
 
-    """ Handle policy (include/exclude) of a given path.
+    """ A node of the PathPolicy trie.
     """
 
-    def __init__(self, includes=None, excludes=None):
-        # Generate the list of root paths:
-        root_paths = {}
-        root_paths.update({PathPolicy.normalize(x): 'include' for x in includes})
-        root_paths.update({PathPolicy.normalize(x): 'exclude' for x in excludes})
+    __slots__ = ('children', 'policy', 'ancestor')
+
+    def __init__(self):
+        self.children = {}
+        self.policy = None  # Recursive policy defined for this path
+        self.ancestor = False  # Path is a parent of an included path
 
-        paths = []
 
-        for root_prefix, root_policy in root_paths.items():
-            # Produce a recursive entry for the root path:
-            paths.append((root_prefix, root_policy, True))
+class PathPolicy:
+
+    """ Handle policy (include/exclude) of a given path.
+
+    Literal paths are compiled into a trie of path components, the most
+    specific path matching wins. Glob patterns (``*``, ``?`` and ``[...]``
+    matching inside a path component, ``**`` matching across components) are
+    compiled into a single regex by policy and take precedence over literal
+    paths, exclude patterns winning over include patterns.
+    """
 
-            # Produce non-recursive entries for each path prefix parts:
-            prefix = os.path.dirname(root_prefix)
-            if root_policy == 'include':
-                while prefix != b'/':
-                    if root_paths.get(prefix) != 'include':
-                        paths.append((prefix, 'include', False))
-                    prefix = os.path.dirname(prefix)
+    GLOB_CHARS = re.compile(rb'[*?[]')
 
-        # Sort paths by length, name, recursiveness
-        self.paths = list(sorted(paths, key=lambda x: (len(x[0]), x[0], -x[2]), reverse=True))
+    def __init__(self, includes=None, excludes=None):
+        self._root = PathPolicyNode()
+        globs = {'include': [], 'exclude': []}
+        include_ancestors = []
+        literals = {}
+
+        for patterns, policy in ((includes or (), 'include'), (excludes or (), 'exclude')):
+            for pattern in patterns:
+                pattern = PathPolicy.normalize(pattern)
+                if PathPolicy.GLOB_CHARS.search(pattern):
+                    globs[policy].append(PathPolicy.translate(pattern))
+                    if policy == 'include':
+                        include_ancestors.append(PathPolicy.translate_ancestors(pattern))
+                else:
+                    literals[pattern] = policy  # Exclude overrides include
+
+        for path, policy in literals.items():
+            self._add(path, policy)
+
+        self._has_globs = bool(globs['include'] or globs['exclude'])
+        self._exclude_globs = self._compile(globs['exclude'], b'(?:/|$)')
+        self._include_globs = self._compile(globs['include'], b'(?:/|$)')
+        self._include_ancestors = self._compile(include_ancestors, b'$')
 
     @staticmethod
     def normalize(path):
@@ -60,17 +86,152 @@ class PathPolicy:
             path = path.encode('utf-8')
         return os.path.normpath(os.path.join(b'/', path))
 
+    @staticmethod
+    def translate(pattern):
+        """ Translate a glob pattern into a regex (without anchors).
+        """
+        i, n = 0, len(pattern)
+        output = []
+        while i < n:
+            char = pattern[i:i + 1]
+            if char == b'*':
+                if pattern[i:i + 3] == b'**/':
+                    output.append(b'(?:[^/]*/)*')  # Zero or more directories
+                    i += 3
+                    continue
+                elif pattern[i:i + 2] == b'**':
+                    output.append(b'.*')
+                    i += 2
+                    continue
+                output.append(b'[^/]*')
+            elif char == b'?':
+                output.append(b'[^/]')
+            elif char == b'[':
+                j = i + 1
+                if pattern[j:j + 1] == b'!':
+                    j += 1
+                if pattern[j:j + 1] == b']':
+                    j += 1
+                j = pattern.find(b']', j)
+                if j == -1:
+                    output.append(b'\\[')
+                else:
+                    chars = pattern[i + 1:j].replace(b'\\', b'\\\\')
+                    if chars.startswith(b'!'):
+                        chars = b'^' + chars[1:]
+                    output.append(b'[' + chars + b']')
+                    i = j
+            else:
+                output.append(re.escape(char))
+            i += 1
+        return b''.join(output)
+
+    @staticmethod
+    def translate_ancestors(pattern):
+        """ Translate a glob pattern into a regex matching its parent paths.
+        """
+        regex = b''
+        for component in reversed(pattern.strip(b'/').split(b'/')):
+            if component == b'**':
+                regex = b'(?:/.*)?'
+            else:
+                regex = b'(?:/' + PathPolicy.translate(component) + regex + b')?'
+        return regex
+
+    @staticmethod
+    def _compile(regexes, suffix):
+        if regexes:
+            return re.compile(b'(?:' + b'|'.join(regexes) + b')' + suffix)
+
+    def _add(self, path, policy):
+        """ Add a literal path into the trie.
+        """
+        node = self._root
+        nodes = []
+        for component in path.split(b'/'):
+            if component:
+                nodes.append(node)
+                node = node.children.setdefault(component, PathPolicyNode())
+        node.policy = policy
+
+        # Mark parents of included paths (except the root):
+        if policy == 'include':
+            for parent in nodes[1:]:
+                parent.ancestor = True
+
+    def _lookup(self, path):
+        """ Lookup a path in the trie.
+
+        Return a tuple (node, policy) where node is the trie node of the path
+        (or None if no rule is defined for the path or its children) and
+        policy the nearest recursive policy applied on the path.
+        """
+        node = self._root
+        policy = node.policy
+        for component in path.split(b'/'):
+            if component:
+                node = node.children.get(component)
+                if node is None:
+                    break
+                elif node.policy is not None:
+                    policy = node.policy
+        return node, policy
+
+    def _glob_included(self, path):
+        """ Return the policy given by glob patterns (or None).
+        """
+        if self._exclude_globs is not None and self._exclude_globs.match(path):
+            return False
+        elif self._include_globs is not None and (self._include_globs.match(path) or
+                                                  self._include_ancestors.match(path)):
+            return True
+
     def included(self, path):
         """ Return True if the path has to be included.
         """
-
-        for prefix, policy, recursive in self.paths:
-            if recursive and path.startswith(prefix):
-                return policy == 'include'
-            elif not recursive and path == prefix:
-                return policy == 'include'
+        if self._has_globs:
+            included = self._glob_included(path)
+            if included is not None:
+                return included
+
+        node, policy = self._lookup(path)
+        if node is not None and node.ancestor:
+            return True
         else:
-            return True  # Default policy is to include
+            return policy != 'exclude'  # Default policy is to include
+
+    def filter(self, directory, names):
+        """ Return the list of names in directory to include.
+
+        This method is intended to be used by remotes to prune excluded items
+        before to stat or list them. Items of a directory without any rule
+        below it are decided at once. The MARTY_EXCLUDE marker is always
+        kept so the backup can still see it, even when excluded by rules.
+        """
+        if self._has_globs:
+            return [x for x in names if x == MARTY_EXCLUDE or self.included(os.path.join(directory, x))]
+
+        node, policy = self._lookup(directory)
+        if node is None or not node.children:
+            if policy != 'exclude':
+                return list(names)
+            return [x for x in names if x == MARTY_EXCLUDE]
+
+        included = []
+        for name in names:
+            if name == MARTY_EXCLUDE:
+                included.append(name)
+                continue
+            child = node.children.get(name)
+            if child is None:
+                child_policy = policy
+            elif child.ancestor:
+                child_policy = 'include'
+            else:
+                child_policy = child.policy or policy
+            if child_policy != 'exclude':
+                included.append(name)
+        return included
 
 
 class RemoteMethod(object):
@@ -80,6 +241,10 @@ class RemoteMethod(object):
 
     config_schema = DefaultRemoteMethodSchema()
 
+    # Sequential remotes can only be read in a single pass through the
+    # iter_stream method instead of get_tree/get_blob/checksum:
+    sequential = False
+
     def __init__(self, name, config):
         self.name = name
         self.config = config
@@ -139,6 +304,20 @@ class RemoteMethod(object):
         """
         raise NotImplementedError('%s remote type does not implement set_blob' % self.__class__.__name__)
 
+    def put_metadata(self, tree, path):
+        """ Put metadata of tree items at the specified path.
+
+        Called once the content of the tree has been restored, so metadata
+        such as modification times are not altered afterwards.
+        """
+
+    def put_hardlink(self, source, path):
+        """ Restore path as a hard link to the already restored source path.
+
+        Remotes not implementing this method get a copy of the blob instead.
+        """
+        raise NotImplementedError('%s remote type does not implement put_hardlink' % self.__class__.__name__)
+
     def checksum(self, path):
         """ Compute checksum of the provided path to blob object.
         """
@@ -154,6 +333,108 @@ class RemoteMethod(object):
         """
         raise NotImplementedError('%s remote type does not implement newer' % self.__class__.__name__)
 
+    def iter_stream(self):
+        """ Iterate over items of a sequential remote.
+
+        Yield tuples (path, item, blob) in the remote order, where item is a
+        dict of Tree item attributes and blob a Blob object for blob items
+        (which must be consumed before to get the next item) or None if the
+        blob item already has a ref. Paths which can't be imported are yielded
+        with a None item and a RemoteOperationError instead of the blob.
+        """
+        raise NotImplementedError('%s remote type does not implement iter_stream' % self.__class__.__name__)
+
+    def asynchronous(self, executor=None):
+        """ Return the asyncio flavor (AsyncRemoteMethod) of this remote.
+
+        Remote methods without native asyncio support are wrapped into an
+        adapter running blocking calls into the provided executor.
+        """
+        return AsyncRemoteMethodAdapter(self, executor)
+
+
+class AsyncRemoteMethod(object):
+
+    """ Base class for asyncio remote methods.
+
+    Coroutine flavor of the backup side of the RemoteMethod interface, used
+    to backup many remotes from a single process. Blob objects returned by
+    get_blob must be readable from an executor thread as they are ingested
+    by the storage outside of the event loop.
+
+    Non-coroutine attributes (name, policy, newer...) are taken from the
+    wrapped synchronous remote.
+    """
+
+    def __init__(self, remote):
+        self.remote = remote
+
+    def __getattr__(self, name):
+        return getattr(self.remote, name)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.remote.name)
+
+    async def __aenter__(self):
+        await self.initialize()
+
+    async def __aexit__(self, type, value, traceback):
+        await self.shutdown()
+
+    async def initialize(self):
+        """ Initialize the AsyncRemoteMethod before to use it.
+        """
+
+    async def shutdown(self):
+        """ Shutdown the AsyncRemoteMethod after it has been used.
+        """
+
+    async def get_tree(self, path):
+        """ Return a Tree object for the specified path.
+        """
+        raise NotImplementedError('%s remote type does not implement get_tree' % self.__class__.__name__)
+
+    async def get_blob(self, path):
+        """ Return a Blob object for the specified path.
+        """
+        raise NotImplementedError('%s remote type does not implement get_blob' % self.__class__.__name__)
+
+    async def checksum(self, path):
+        """ Compute checksum of the provided path to blob object.
+        """
+        raise NotImplementedError('%s remote type does not implement checksum' % self.__class__.__name__)
+
+
+class AsyncRemoteMethodAdapter(AsyncRemoteMethod):
+
+    """ Expose a synchronous RemoteMethod through the AsyncRemoteMethod API.
+
+    Blocking calls are executed into the provided executor (or the default
+    executor of the event loop if None).
+    """
+
+    def __init__(self, remote, executor=None):
+        super().__init__(remote)
+        self.executor = executor
+
+    def _run(self, func, *args):
+        return asyncio.get_event_loop().run_in_executor(self.executor, func, *args)
+
+    async def initialize(self):
+        await self._run(self.remote.initialize)
+
+    async def shutdown(self):
+        await self._run(self.remote.shutdown)
+
+    async def get_tree(self, path):
+        return await self._run(self.remote.get_tree, path)
+
+    async def get_blob(self, path):
+        return await self._run(self.remote.get_blob, path)
+
+    async def checksum(self, path):
+        return await self._run(self.remote.checksum, path)
+
 
 class RemoteManager(object):
 
@@ -0,0 +1,179 @@
+import os
+import asyncio
+import tempfile
+import subprocess
+
+from confiture.schema.containers import Section, Value
+from confiture.schema.types import String
+
+from marty.remotemethods import DefaultRemoteMethodSchema, RemoteMethod, AsyncRemoteMethod, RemoteOperationError
+from marty.datastructures import Tree, Blob
+
+
+class CommandOutput(object):
+
+    """ File-like object streaming the standard output of a running command.
+
+    The exit status of the command is checked once its output has been
+    entirely read, a RemoteOperationError is raised if the command failed so
+    a truncated output is never ingested as a valid blob.
+    """
+
+    def __init__(self, name, stdout, wait):
+        self.name = name
+        self._stdout = stdout
+        self._wait = wait
+        self._finished = False
+
+    def read(self, size=-1):
+        buf = self._stdout.read(size)
+        if not buf and size != 0:
+            self._finish()
+        return buf
+
+    def _finish(self):
+        if not self._finished:
+            self._finished = True
+            status, error = self._wait()
+            if status != 0:
+                raise RemoteOperationError('Command %s failed with status %s: %s' % (self.name, status, error))
+
+    def close(self):
+        self._stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+OUTPUT_SPOOL_SIZE = 1024 * 1024
+OUTPUT_READ_SIZE = 64 * 1024
+
+
+class ExecCommandSchema(Section):
+
+    _meta = {'args': Value(String()),
+             'unique': True,
+             'repeat': (0, None)}
+
+    run = Value(String())
+
+
+class ExecRemoteMethodSchema(DefaultRemoteMethodSchema):
+
+    command = ExecCommandSchema()
+
+
+class Exec(RemoteMethod):
+
+    """ Backup the output of a set of named commands.
+
+    Each command is exposed as a blob in the root tree, its output is
+    streamed into the storage while it runs. Commands are run locally using
+    the shell, see SSHExec to run them on a remote server.
+    """
+
+    config_schema = ExecRemoteMethodSchema()
+
+    @property
+    def commands(self):
+        return {x.args.encode('utf-8'): x.get('run') for x in self.config.subsections('command')}
+
+    def execute(self, command):
+        """ Execute the command and return a tuple (stdout, wait).
+
+        Where stdout is a file object on the command output and wait a
+        callable returning a tuple (exit_status, error_message) once the
+        command has ended.
+        """
+        stderr = tempfile.TemporaryFile()
+        try:
+            process = subprocess.Popen(command, shell=True, stdin=subprocess.DEVNULL,
+                                       stdout=subprocess.PIPE, stderr=stderr)
+        except OSError as err:
+            stderr.close()
+            raise RemoteOperationError(err.strerror)
+
+        def wait():
+            status = process.wait()
+            stderr.seek(0)
+            error = stderr.read().decode('utf-8', 'replace').strip()
+            stderr.close()
+            return status, error
+
+        return process.stdout, wait
+
+    def get_tree(self, path):
+        tree = Tree()
+        if path.strip(os.sep.encode('utf-8')):
+            raise RemoteOperationError('%s is not a directory' % path.decode('utf-8', 'replace'))
+        for name in self.commands:
+            tree.add(name, {'type': 'blob', 'filetype': 'regular', 'mode': 0o600})
+        return tree
+
+    def get_command(self, path):
+        """ Get a tuple (name, command) of the command exposed at path.
+        """
+        name = path.strip(os.sep.encode('utf-8'))
+        command = self.commands.get(name)
+        if command is None:
+            raise RemoteOperationError('Unknown command %s' % name.decode('utf-8', 'replace'))
+        return name.decode('utf-8', 'replace'), command
+
+    def get_blob(self, path):
+        name, command = self.get_command(path)
+        stdout, wait = self.execute(command)
+        return Blob(blob=CommandOutput(name, stdout, wait))
+
+    def checksum(self, path):
+        return None  # Output is only known once the command has been run
+
+    def newer(self, attr_new, attr_old):
+        return True  # Commands are always run again
+
+    def asynchronous(self, executor=None):
+        return AsyncExec(self)
+
+
+class AsyncExec(AsyncRemoteMethod):
+
+    """ Native asyncio flavor of the Exec remote method.
+
+    Commands are run as asyncio subprocesses and their output is read by the
+    event loop into a spooled temporary file, so no worker thread is held
+    while commands run. The blob is only returned once the command succeeded.
+    """
+
+    async def get_tree(self, path):
+        return self.remote.get_tree(path)
+
+    async def get_blob(self, path):
+        name, command = self.remote.get_command(path)
+        try:
+            process = await asyncio.create_subprocess_shell(command, stdin=subprocess.DEVNULL,
+                                                            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as err:
+            raise RemoteOperationError(err.strerror)
+        stderr = asyncio.ensure_future(process.stderr.read())
+        output = tempfile.SpooledTemporaryFile(OUTPUT_SPOOL_SIZE)
+        try:
+            buf = await process.stdout.read(OUTPUT_READ_SIZE)
+            while buf:
+                output.write(buf)
+                buf = await process.stdout.read(OUTPUT_READ_SIZE)
+            error = (await stderr).decode('utf-8', 'replace').strip()
+            status = await process.wait()
+            if status != 0:
+                raise RemoteOperationError('Command %s failed with status %s: %s' % (name, status, error))
+        except BaseException:
+            output.close()
+            if process.returncode is None:
+                process.kill()
+            raise
+        output.seek(0)
+        return Blob(blob=output)
+
+    async def checksum(self, path):
+        return self.remote.checksum(path)
@@ -1,13 +1,13 @@
 import os
 import stat
 import hashlib
-import shutil
 
 from confiture.schema.containers import Value
 from confiture.schema.types import Path
 
 from marty.remotemethods import DefaultRemoteMethodSchema, RemoteMethod, RemoteOperationError
 from marty.datastructures import Tree, Blob
+from marty.fileops import data_extents, iter_chunks, copy_file, hash_file
 
 
 class LocalRemoteMethodSchema(DefaultRemoteMethodSchema):
@@ -22,10 +22,25 @@ class Local(RemoteMethod):
 
     config_schema = LocalRemoteMethodSchema()
 
+    def __init__(self, name, config):
+        super().__init__(name, config)
+        self._reset_hardlinks()
+
+    def _reset_hardlinks(self):
+        self._inodes = {}  # (dev, ino) -> hardlink group (path of the first link)
+        self._hardlinks = {}  # path -> (dev, ino) of files having several links
+        self._hardlink_refs = {}  # (dev, ino) -> ref
+
     @property
     def root(self):
         return self.config.get('root').encode('utf-8')
 
+    def initialize(self):
+        self._reset_hardlinks()
+
+    def shutdown(self):
+        self._reset_hardlinks()
+
     def get_tree(self, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         directory = os.path.join(self.root, path)
@@ -35,6 +50,9 @@ class Local(RemoteMethod):
         except OSError as err:
             raise RemoteOperationError(err.strerror)
 
+        # Prune excluded items before to stat them:
+        directory_items = self.policy.filter(os.path.join(b'/', path), directory_items)
+
         for filename in directory_items:
             assert isinstance(filename, bytes)
             item = {}
@@ -43,6 +61,13 @@ class Local(RemoteMethod):
             if stat.S_ISREG(fstat.st_mode):
                 item['type'] = 'blob'
                 item['filetype'] = 'regular'
+                if fstat.st_nlink > 1:
+                    # Record the hardlink group of the file, named after the
+                    # path of the first link seen during the backup:
+                    inode = (fstat.st_dev, fstat.st_ino)
+                    remote_name = os.path.join(b'/', path, filename)
+                    item['hardlink'] = self._inodes.setdefault(inode, remote_name)
+                    self._hardlinks[remote_name] = inode
             elif stat.S_ISDIR(fstat.st_mode):
                 item['type'] = 'tree'
                 item['filetype'] = 'directory'
@@ -69,7 +94,7 @@ class Local(RemoteMethod):
     def put_tree(self, tree, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         directory = os.path.join(self.root, path)
-        for name, item in tree.items():
+        for name, item in tree.iter_items():
             fullname = os.path.join(directory, name)
             try:
                 fstat = os.lstat(fullname)
@@ -125,34 +150,70 @@ class Local(RemoteMethod):
             if 'mode' in item:
                 try:
                     os.chmod(fullname, item['mode'], follow_symlinks=False)
-                except SystemError:
-                    pass  # Workaround follow_symlinks not implemented in Python 3.5 (bug?)
+                except (SystemError, NotImplementedError):
+                    pass  # Symlinks modes can't be set on some platforms (eg: Linux)
 
     def get_blob(self, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         try:
-            blob = Blob(blob=open(os.path.join(self.root, path), 'rb'))
+            fblob = open(os.path.join(self.root, path), 'rb')
+            extents = data_extents(fblob)
+            size = os.fstat(fblob.fileno()).st_size if extents is not None else None
         except OSError as err:
             raise RemoteOperationError(err.strerror)
-        return blob
+        return Blob(blob=fblob, extents=extents, size=size, local=True)
 
     def put_blob(self, blob, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         fullname = os.path.join(self.root, path)
         try:
-            shutil.copyfileobj(blob.to_file(), open(fullname, 'wb'))
+            with open(fullname, 'wb') as fout:
+                copy_file(blob.to_file(), fout, local=getattr(blob, 'local', False))
+        except OSError as err:
+            raise RemoteOperationError(err.strerror)
+
+    def put_metadata(self, tree, path):
+        path = path.lstrip(os.sep.encode('utf-8'))
+        directory = os.path.join(self.root, path)
+        for name, item in tree.iter_items():
+            if 'mtime' in item and item.get('filetype') in ('regular', 'directory', 'link'):
+                try:
+                    os.utime(os.path.join(directory, name), (item.get('atime', item['mtime']), item['mtime']),
+                             follow_symlinks=False)
+                except OSError as err:
+                    raise RemoteOperationError(err.strerror)
+
+    def put_hardlink(self, source, path):
+        source = os.path.join(self.root, source.lstrip(os.sep.encode('utf-8')))
+        fullname = os.path.join(self.root, path.lstrip(os.sep.encode('utf-8')))
+        try:
+            if os.path.lexists(fullname):
+                os.unlink(fullname)
+            os.link(source, fullname)
         except OSError as err:
             raise RemoteOperationError(err.strerror)
 
     def checksum(self, path):
+        # Files with several links are only hashed once by backup:
+        inode = self._hardlinks.get(path)
+        if inode is not None and inode in self._hardlink_refs:
+            return self._hardlink_refs[inode]
+        ref = self._checksum(path)
+        if inode is not None:
+            self._hardlink_refs[inode] = ref
+        return ref
+
+    def _checksum(self, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         filename = os.path.join(self.root, path)
         filehash = hashlib.sha1()
         try:
             with open(filename, 'rb') as fhash:
-                buf = True
-                while buf:
-                    buf = fhash.read(8192)
+                extents = data_extents(fhash)
+                if extents is None:
+                    return hash_file(fhash)
+                size = os.fstat(fhash.fileno()).st_size
+                for buf in iter_chunks(fhash, extents, size):
                     filehash.update(buf)
         except OSError as err:
             raise RemoteOperationError(err.strerror)
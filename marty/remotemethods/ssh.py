@@ -1,12 +1,14 @@
 import os
 import stat
 import inspect
+import threading
 
 import paramiko
 from confiture.schema.containers import Value
 from confiture.schema.types import String, Boolean
 
 from marty.remotemethods import DefaultRemoteMethodSchema, RemoteMethod, RemoteOperationError
+from marty.remotemethods.exec import Exec, ExecCommandSchema
 from marty.datastructures import Tree, Blob
 
 
@@ -104,6 +106,7 @@ class SSH(BaseSSH):
     def initialize(self):
         super().initialize()
         self._sftp = self._ssh.open_sftp()
+        self._local = threading.local()
 
         # Launch the checksum computing loop:
         self._checksum_stdin, self._checksum_stdout, _ = self._ssh.exec_command(CHECKSUM_LOOP)
@@ -114,14 +117,29 @@ class SSH(BaseSSH):
     def root(self):
         return self.config.get('root').encode('utf-8')
 
+    @property
+    def _thread_sftp(self):
+        """ SFTP session of the calling thread, so concurrent transfers are
+            done in parallel channels.
+        """
+        sftp = getattr(self._local, 'sftp', None)
+        if sftp is None:
+            sftp = self._local.sftp = self._ssh.open_sftp()
+        return sftp
+
     def get_tree(self, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         directory = os.path.join(self.root, path)
         tree = Tree()
         directory_items = self._sftp.listdir_attr_b(directory)
 
+        # Prune excluded items before to handle them:
+        included = set(self.policy.filter(os.path.join(b'/', path), [x.filename for x in directory_items]))
+
         for fattr in directory_items:
             filename = fattr.filename
+            if filename not in included:
+                continue
             item = {}
             if stat.S_ISREG(fattr.st_mode):
                 item['type'] = 'blob'
@@ -153,7 +171,7 @@ class SSH(BaseSSH):
 
         directory_stats = {x.filename: x for x in self._sftp.listdir_attr_b(directory)}
 
-        for name, item in tree.items():
+        for name, item in tree.iter_items():
             fullname = os.path.join(directory, name)
             fstat = directory_stats.get(name)
 
@@ -213,10 +231,22 @@ class SSH(BaseSSH):
         path = path.lstrip(os.sep.encode('utf-8'))
         fullname = os.path.join(self.root, path)
         try:
-            self._sftp.putfo(blob.to_file(), fullname)
+            self._thread_sftp.putfo(blob.to_file(), fullname)
         except Exception as err:
             raise RemoteOperationError(str(err))
 
+    def put_metadata(self, tree, path):
+        path = path.lstrip(os.sep.encode('utf-8'))
+        directory = os.path.join(self.root, path)
+        for name, item in tree.iter_items():
+            # Symlinks times can't be set with SFTP:
+            if 'mtime' in item and item.get('filetype') in ('regular', 'directory'):
+                try:
+                    self._thread_sftp.utime(os.path.join(directory, name),
+                                            (item.get('atime', item['mtime']), item['mtime']))
+                except IOError as err:
+                    raise RemoteOperationError(err.strerror)
+
     def checksum(self, path):
         path = path.lstrip(os.sep.encode('utf-8'))
         fullname = os.path.join(self.root, path)
@@ -266,3 +296,33 @@ class Mikrotik(BaseSSH):
 
     def newer(self, attr_new, attr_old):
         return False
+
+
+class SSHExecRemoteMethodSchema(BaseSSHRemoteMethodSchema):
+
+    command = ExecCommandSchema()
+
+
+class SSHExec(Exec, BaseSSH):
+
+    """ Backup the output of a set of named commands run through SSH.
+    """
+
+    config_schema = SSHExecRemoteMethodSchema()
+
+    def execute(self, command):
+        try:
+            stdin, stdout, stderr = self._ssh.exec_command(command)
+        except paramiko.ssh_exception.SSHException as err:
+            raise RemoteOperationError('SSH: %s' % err)
+        stdin.close()
+
+        def wait():
+            status = stdout.channel.recv_exit_status()
+            return status, stderr.read().decode('utf-8', 'replace').strip()
+
+        return stdout, wait
+
+    def asynchronous(self, executor=None):
+        # Commands are run through Paramiko, which is blocking:
+        return RemoteMethod.asynchronous(self, executor)
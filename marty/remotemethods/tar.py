@@ -0,0 +1,98 @@
+import os
+import sys
+import stat
+import tarfile
+
+from confiture.schema.containers import Value
+from confiture.schema.types import String
+
+from marty.remotemethods import DefaultRemoteMethodSchema, RemoteMethod, RemoteOperationError
+from marty.datastructures import Blob
+
+
+class TarRemoteMethodSchema(DefaultRemoteMethodSchema):
+
+    path = Value(String(), default='-')  # Default: read the standard input
+
+
+class Tar(RemoteMethod):
+
+    """ Import a tar archive or stream (mirror of the tar export).
+
+    The archive is read in a single sequential pass, compression is
+    automatically detected. Use "-" as path to read the standard input.
+    """
+
+    config_schema = TarRemoteMethodSchema()
+    sequential = True
+
+    def initialize(self):
+        path = self.config.get('path')
+        try:
+            if path == '-':
+                self._tar = tarfile.open(fileobj=sys.stdin.buffer, mode='r|*')
+            else:
+                self._tar = tarfile.open(path, mode='r|*')
+        except (OSError, tarfile.TarError) as err:
+            raise RemoteOperationError('Unable to open tar archive: %s' % err)
+
+    def shutdown(self):
+        self._tar.close()
+
+    def iter_stream(self):
+        refs = {}  # Content (ref or inline data) of regular files, used to resolve hardlinks
+        try:
+            for member in self._tar:
+                name = member.name.encode('utf-8', 'surrogateescape')
+                name = os.path.normpath(os.path.join(b'/', name))
+                item = {}
+                blob = None
+                size = member.size
+                if member.isreg():
+                    item['type'] = 'blob'
+                    item['filetype'] = 'regular'
+                    blob = Blob(blob=self._tar.extractfile(member))
+                elif member.islnk():
+                    linkname = member.linkname.encode('utf-8', 'surrogateescape')
+                    linkname = os.path.normpath(os.path.join(b'/', linkname))
+                    if linkname not in refs:
+                        # Data is only stored with the first link in archives:
+                        yield name, None, RemoteOperationError('Hardlink target %s has not been imported'
+                                                               % linkname.decode('utf-8', 'replace'))
+                        continue
+                    item['type'] = 'blob'
+                    item['filetype'] = 'regular'
+                    content, size = refs[linkname]
+                    item.update(content)
+                elif member.isdir():
+                    item['type'] = 'tree'
+                    item['filetype'] = 'directory'
+                elif member.issym():
+                    item['filetype'] = 'link'
+                    item['link'] = member.linkname.encode('utf-8', 'surrogateescape')
+                elif member.isfifo():
+                    item['filetype'] = 'fifo'
+                else:
+                    yield name, None, RemoteOperationError('Unsupported file type')
+                    continue
+
+                item['uid'] = member.uid
+                item['gid'] = member.gid
+                item['mode'] = member.mode & (stat.S_IRWXU | stat.S_IRWXG | stat.S_IRWXO | stat.S_ISVTX)
+                item['mtime'] = int(member.mtime)
+                # Only pax archives carry atime and ctime, default to mtime:
+                for attr in ('atime', 'ctime'):
+                    item[attr] = int(float(member.pax_headers.get(attr, item['mtime'])))
+                item['size'] = size
+
+                yield name, item, blob
+
+                if blob is not None:
+                    content = {k: item[k] for k in ('ref', 'data') if k in item}
+                    if content:
+                        refs[name] = content, size
+        except tarfile.TarError as err:
+            raise RemoteOperationError('Error while reading tar archive: %s' % err)
+
+    def newer(self, attr_new, attr_old):
+        return True  # Payloads are read anyway
@@ -1,10 +1,12 @@
+import io
 import re
 import fnmatch
 
 from confiture.schema.containers import Section, Value
-from confiture.schema.types import String
+from confiture.schema.types import String, Integer, Boolean
 
-from marty.datastructures import Blob, Tree, Backup, MartyObjectDecodeError
+from marty.fileops import hash_file
+from marty.datastructures import Blob, Tree, SplitTree, Backup, MartyObjectDecodeError, NODE_ITEM_TYPE
 
 
 class NameResolver(object):
@@ -66,6 +68,12 @@ class DefaultStorageSchema(Section):
 
     _meta = {}
     type = Value(String())
+    inline_threshold = Value(Integer(min=0), default=0)  # Default: disabled
+    tree_split_threshold = Value(Integer(min=0), default=0)  # Default: disabled
+    gc_workers = Value(Integer(min=1), default=4)
+    gc_grace_period = Value(Integer(min=0), default=60)  # Default: 1h
+    refcounts = Value(Boolean(), default=False)
+    check_workers = Value(Integer(min=1), default=4)
 
 
 class Storage(object):
@@ -79,6 +87,8 @@ class Storage(object):
         self.name = name
         self.config = config
         self.resolver = NameResolver(self)
+        self._refcounts = None
+        self._checklog = None
         self.prepare()
 
     def get(self, ref, type=None):
@@ -99,15 +109,79 @@ class Storage(object):
         """ Decode a tree object from provided ref.
         """
         try:
-            return self.get(ref, Tree)
+            tree = self.get(ref, Tree)
         except MartyObjectDecodeError:
-            return self.get(self.get(ref, Backup).root, Tree)
+            tree = self.get(self.get(ref, Backup).root, Tree)
+        if tree.is_split_index:
+            tree = SplitTree(tree, self.get_tree)
+        return tree
 
     def get_backup(self, ref):
         """ Decode backup object from provided ref.
         """
         return self.get(ref, Backup)
 
+    def get_item_blob(self, item):
+        """ Get the blob object of a blob Tree item.
+
+        Handle blobs stored inline into the Tree item.
+        """
+        if 'data' in item:
+            return Blob(blob=io.BytesIO(item['data']))
+        else:
+            return self.get_blob(item['ref'])
+
+    def item_size(self, item):
+        """ Get size of the blob object of a blob Tree item.
+        """
+        if 'data' in item:
+            return len(item['data'])
+        else:
+            return self.size(item['ref'])
+
+    @property
+    def gc_workers(self):
+        """ Number of workers used by the garbage collector.
+        """
+        return self.config.get('gc_workers')
+
+    @property
+    def gc_grace_period(self):
+        """ Objects modified since less than this number of seconds are kept
+            by the garbage collector.
+        """
+        return self.config.get('gc_grace_period') * 60
+
+    @property
+    def refcounts(self):
+        """ The reference count index of objects (None if disabled).
+        """
+        if not self.config.get('refcounts'):
+            return None
+        if self._refcounts is None:
+            self._refcounts = self.open_refcounts()
+        return self._refcounts
+
+    @property
+    def checklog(self):
+        """ The verification log of objects.
+        """
+        if self._checklog is None:
+            self._checklog = self.open_checklog()
+        return self._checklog
+
+    @property
+    def check_workers(self):
+        """ Number of workers used to check objects.
+        """
+        return self.config.get('check_workers')
+
+    @property
+    def inline_threshold(self):
+        """ Blobs smaller than this size are stored inline into Tree items.
+        """
+        return self.config.get('inline_threshold')
+
     def resolve(self, label):
         """ Resolve a label.
         """
@@ -163,6 +237,41 @@ class Storage(object):
         """
         raise NotImplementedError('%s storage type does not implement ingest' % self.__class__.__name__)
 
+    def ingest_tree(self, tree):
+        """ Ingest the provided tree into the store.
+
+        Trees having more items than the split threshold are split into
+        nodes of this average number of items, ingested separately and
+        referenced by an index (itself split if needed). Return the same
+        tuple than ingest, sizes including all the nodes.
+        """
+        threshold = self.config.get('tree_split_threshold')
+        if not threshold or len(tree) <= threshold:
+            return self.ingest(tree)
+
+        total_size = 0
+        total_stored_size = 0
+        level = 0
+        while True:
+            index = Tree()
+            for node in tree.split(threshold, level):
+                ref, size, stored_size = self.ingest(node)
+                total_size += size
+                total_stored_size += stored_size
+                if level:
+                    count = sum(x.get('count', 0) for _, x in node.iter_items())
+                else:
+                    count = len(node)
+                name = node.names()[0]
+                index.add(name, {'type': NODE_ITEM_TYPE, 'ref': ref, 'count': count, 'level': level})
+            if len(index) <= threshold or len(index) >= len(tree):
+                break
+            tree = index
+            level += 1
+
+        ref, size, stored_size = self.ingest(index)
+        return ref, total_size + size, total_stored_size + stored_size
+
     def exists(self, ref):
         """ Return True if an object with provided ref already exists in storage.
         """
@@ -173,11 +282,42 @@ class Storage(object):
         """
         raise NotImplementedError('%s storage type does not implement list' % self.__class__.__name__)
 
+    def list_sorted(self, prefix=''):
+        """ List objects having refs starting with prefix in ascending order
+            (generator).
+
+        Storages able to list objects in order should override this method
+        to avoid sorting the whole list in memory.
+        """
+        return iter(sorted(x for x in self.list() if x.startswith(prefix)))
+
+    def list_shards(self):
+        """ List prefixes of refs splitting the pool into shards, each of them
+            listed by list_sorted.
+
+        Storages should override this method to match their layout, so each
+        shard can be listed independently.
+        """
+        return ['%02x' % x for x in range(256)]
+
     def delete(self, ref):
         """ Delete object from pool.
         """
         raise NotImplementedError('%s storage type does not implement remove' % self.__class__.__name__)
 
+    def delete_many(self, refs, before=None):
+        """ Delete a batch of objects from pool.
+
+        If before is provided, objects ingested or reused since this
+        timestamp are kept. Return the list of deleted refs.
+        """
+        deleted = []
+        for ref in refs:
+            if before is None or self.mtime(ref) < before:
+                self.delete(ref)
+                deleted.append(ref)
+        return deleted
+
     def open(self, ref):
         """ Open stream to the provided object.
         """
@@ -188,6 +328,12 @@ class Storage(object):
         """
         raise NotImplementedError('%s storage type does not implement size' % self.__class__.__name__)
 
+    def verify(self, ref):
+        """ Return True if the content of the object matches its ref.
+        """
+        with self.open(ref) as fobject:
+            return hash_file(fobject) == ref
+
     def read_label(self, name):
         """ Delete a label.
         """
@@ -209,3 +355,67 @@ class Storage(object):
         """ Get the list of existing labels (generator).
         """
         raise NotImplementedError('%s storage type does not implement list_labels' % self.__class__.__name__)
+
+    def open_refcounts(self):
+        """ Open the reference count index of the storage.
+        """
+        raise NotImplementedError('%s storage type does not implement open_refcounts' % self.__class__.__name__)
+
+    def open_checklog(self):
+        """ Open the verification log of the storage.
+        """
+        raise NotImplementedError('%s storage type does not implement open_checklog' % self.__class__.__name__)
+
+    def open_marks(self, ref):
+        """ Open stream to the persisted marks (objects reachable) of a backup.
+
+        Return None if no marks are persisted for this backup.
+        """
+        raise NotImplementedError('%s storage type does not implement open_marks' % self.__class__.__name__)
+
+    def write_marks(self, ref, marks):
+        """ Persist the marks (objects reachable) of a backup.
+        """
+        raise NotImplementedError('%s storage type does not implement write_marks' % self.__class__.__name__)
+
+    def delete_marks(self, ref):
+        """ Delete the persisted marks of a backup.
+        """
+        raise NotImplementedError('%s storage type does not implement delete_marks' % self.__class__.__name__)
+
+    def list_marks(self):
+        """ Get the list of backups having persisted marks (generator).
+        """
+        raise NotImplementedError('%s storage type does not implement list_marks' % self.__class__.__name__)
+
+    def mtime(self, ref):
+        """ Get the timestamp of the last ingestion or reuse of an object.
+        """
+        raise NotImplementedError('%s storage type does not implement mtime' % self.__class__.__name__)
+
+    def touch(self, ref):
+        """ Mark an existing object as reused now (see mtime).
+
+        Return False if the object does not exist.
+        """
+        raise NotImplementedError('%s storage type does not implement touch' % self.__class__.__name__)
+
+    def open_session(self, roots=()):
+        """ Open a backup session and return its identifier.
+
+        While a session is open, the garbage collector keeps objects
+        reachable from the provided roots (backup refs) and objects ingested
+        or reused since the session start.
+        """
+        raise NotImplementedError('%s storage type does not implement open_session' % self.__class__.__name__)
+
+    def close_session(self, session):
+        """ Close a backup session.
+        """
+        raise NotImplementedError('%s storage type does not implement close_session' % self.__class__.__name__)
+
+    def list_sessions(self):
+        """ Get the list of open sessions as (session, start, roots) tuples
+            (generator).
+        """
+        raise NotImplementedError('%s storage type does not implement list_sessions' % self.__class__.__name__)
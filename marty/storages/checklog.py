@@ -0,0 +1,87 @@
+""" Verification log of objects.
+"""
+
+import sqlite3
+import threading
+
+
+class CheckLog(object):
+
+    """ Persistent log of the last verification of objects.
+
+    For each verified object, the time of its last verification and its
+    result (valid or corrupted) are stored in a SQLite database.
+    """
+
+    def __init__(self, filename):
+        self._filename = filename
+        self._db = sqlite3.connect(filename, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')  # Allow to read while updating
+        self._db.execute('CREATE TABLE IF NOT EXISTS checks '
+                         '(ref BLOB PRIMARY KEY, time REAL NOT NULL, valid INTEGER NOT NULL) '
+                         'WITHOUT ROWID')
+        self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self._db.commit()
+        self._lock = threading.Lock()
+
+    def update(self, checks):
+        """ Record checks from a dict ref -> (time, valid).
+        """
+        with self._lock, self._db:
+            self._db.executemany('INSERT OR REPLACE INTO checks VALUES (?, ?, ?)',
+                                 ((bytes.fromhex(k), t, v) for k, (t, v) in checks.items()))
+
+    def delete(self, refs):
+        """ Forget checks of provided refs (deleted objects).
+        """
+        with self._lock, self._db:
+            self._db.executemany('DELETE FROM checks WHERE ref = ?', ((bytes.fromhex(x),) for x in refs))
+
+    def get_state(self, key, default=None):
+        """ Get a persisted state value (eg: position of a running check).
+        """
+        with self._lock:
+            row = self._db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def set_state(self, key, value):
+        """ Persist a state value.
+        """
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def _iter_query(self, query, params=()):
+        # Use a dedicated connection, so the log can be updated meanwhile:
+        db = sqlite3.connect(self._filename, check_same_thread=False)
+        try:
+            cursor = db.execute(query, params)
+            rows = cursor.fetchmany(1000)
+            while rows:
+                yield from rows
+                rows = cursor.fetchmany(1000)
+        finally:
+            db.close()
+
+    def __iter__(self):
+        return self.iter_from()
+
+    def iter_from(self, start=b''):
+        """ Iterate over (digest, time, valid) of checked objects, in ascending
+            order of digests, starting from the provided digest.
+        """
+        return self._iter_query('SELECT ref, time, valid FROM checks WHERE ref >= ? ORDER BY ref', (start,))
+
+    def stats(self):
+        """ Get a tuple (count, corrupted, oldest) of the number of checked
+            objects, of corrupted ones and the time of the oldest check.
+        """
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*), COALESCE(SUM(NOT valid), 0), MIN(time) FROM checks').fetchone()
+
+    def corrupted(self):
+        """ Iterate over the refs of objects found corrupted by their last check.
+        """
+        return (x.hex() for x, in self._iter_query('SELECT ref FROM checks WHERE NOT valid ORDER BY ref'))
+
+    def close(self):
+        self._db.close()
@@ -1,4 +1,8 @@
 import os
+import json
+import time
+import uuid
+import socket
 import hashlib
 import tempfile
 
@@ -6,6 +10,19 @@ from confiture.schema.containers import Value
 from confiture.schema.types import Path
 
 from marty.storages import DefaultStorageSchema, Storage
+from marty.storages.refcounts import RefcountIndex
+from marty.storages.checklog import CheckLog
+from marty.fileops import iter_chunks, is_zero, clone_file, hash_file, read_full
+
+
+def _process_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # Process exists but is owned by another user
+    return True
 
 
 class FilesystemStorageSchema(DefaultStorageSchema):
@@ -19,6 +36,7 @@ class Filesystem(Storage):
     """
 
     INGEST_READ_SIZE = 32768
+    INGEST_MEMORY_SIZE = 1048576  # Objects up to this size are ingested in memory
     POOL_NAME_DEPTH = 3
 
     config_schema = FilesystemStorageSchema()
@@ -35,6 +53,18 @@ class Filesystem(Storage):
     def pool(self):
         return os.path.join(self.location, 'pool')
 
+    @property
+    def marks(self):
+        return os.path.join(self.location, 'marks')
+
+    @property
+    def sessions(self):
+        return os.path.join(self.location, 'sessions')
+
+    @property
+    def trash(self):
+        return os.path.join(self.location, 'trash')
+
     def _get_pool_dir(self, filename):
         return os.path.join(self.pool, *filename[:self.POOL_NAME_DEPTH])
 
@@ -58,36 +88,152 @@ class Filesystem(Storage):
             os.mkdir(self.pool)
         if not os.path.exists(self.labels):
             os.mkdir(self.labels)
+        if not os.path.exists(self.marks):
+            os.mkdir(self.marks)
+        if not os.path.exists(self.sessions):
+            os.mkdir(self.sessions)
+        if not os.path.exists(self.trash):
+            os.mkdir(self.trash)
+
+    def _link_temp(self, ftemp, hex_hash, size):
+        """ Link a temporary file into the pool (if not already existing).
+
+        Return the stored size.
+        """
+        if self.touch(hex_hash):
+            return 0
+        self._makedirs(self._get_pool_dir(hex_hash))
+        try:
+            os.link(ftemp.name, self._get_pool_name(hex_hash))
+        except FileExistsError:
+            return 0  # Concurrently ingested
+        return size
+
+    def _ingest_buffer(self, data):
+        """ Ingest an object entirely loaded in memory.
+
+        The object is hashed first and only written if not already existing,
+        using an atomic rename of its temporary file.
+        """
+        hex_hash = hashlib.sha1(data).hexdigest()
+        if self.touch(hex_hash):
+            return hex_hash, len(data), 0
+        self._makedirs(self._get_pool_dir(hex_hash))
+        fd, temp_name = tempfile.mkstemp(dir=self.location)
+        try:
+            with os.fdopen(fd, 'wb') as ftemp:
+                ftemp.write(data)
+            os.rename(temp_name, self._get_pool_name(hex_hash))
+        except BaseException:
+            os.unlink(temp_name)
+            raise
+        return hex_hash, len(data), len(data)
+
+    def _ingest_local(self, obj_file):
+        """ Ingest a local file using kernel-side copy (or reflink clone).
+
+        The ref is computed on the copy, so the name of the pool object
+        always matches its content even if the source changes meanwhile.
+        Return None if no kernel-side copy method is supported.
+        """
+        with tempfile.NamedTemporaryFile(dir=self.location) as ftemp:
+            size = clone_file(obj_file, ftemp)
+            if size is None:
+                return None
+            hex_hash = hash_file(ftemp, mapped=True)
+            return hex_hash, size, self._link_temp(ftemp, hex_hash, size)
 
     def ingest(self, obj):
         obj_file = obj.to_file()
+        extents = getattr(obj, 'extents', None)
+
+        if extents is not None:
+            head = b''  # Sparse files are never loaded in memory
+        elif getattr(obj, 'local', False) and os.fstat(obj_file.fileno()).st_size > self.INGEST_MEMORY_SIZE:
+            ingested = self._ingest_local(obj_file)
+            if ingested is not None:
+                return ingested
+            head = b''
+        else:
+            # Small objects are hashed in memory before to be written:
+            head = read_full(obj_file, self.INGEST_MEMORY_SIZE + 1)
+            if len(head) <= self.INGEST_MEMORY_SIZE:
+                return self._ingest_buffer(head)
+
         size = 0
         with tempfile.NamedTemporaryFile(dir=self.location) as ftemp:
-            fhash = hashlib.sha1()
-            buf = True
-            while buf:
-                buf = obj_file.read(self.INGEST_READ_SIZE)
+            fhash = hashlib.sha1(head)
+            ftemp.write(head)
+            size += len(head)
+            for buf in iter_chunks(obj_file, extents, getattr(obj, 'size', None), self.INGEST_READ_SIZE):
                 fhash.update(buf)
-                ftemp.write(buf)
+                if is_zero(buf):
+                    ftemp.seek(len(buf), os.SEEK_CUR)  # Keep holes in pool files
+                else:
+                    ftemp.write(buf)
                 size += len(buf)
-            # FIXME: protect this section with a lock
+            ftemp.truncate(size)
             hex_hash = fhash.hexdigest()
-            if not self.exists(hex_hash):
-                self._makedirs(self._get_pool_dir(hex_hash))
-                os.link(ftemp.name, self._get_pool_name(hex_hash))
-                stored_size = size
-            else:
-                stored_size = 0
-            # FIXME: end of protected section
-            return hex_hash, size, stored_size
+            return hex_hash, size, self._link_temp(ftemp, hex_hash, size)
 
     def list(self):
         for _, _, filename in os.walk(self.pool):
             yield from filename
 
+    def list_sorted(self, prefix=''):
+        # Pool directories are named after the first characters of the refs
+        # they contain, browsing them in order lists refs in order:
+        def _walker(directory, depth):
+            try:
+                names = sorted(os.listdir(directory))
+            except FileNotFoundError:
+                return
+            for name in names:
+                if depth < self.POOL_NAME_DEPTH:
+                    if depth >= len(prefix) or name == prefix[depth]:
+                        yield from _walker(os.path.join(directory, name), depth + 1)
+                elif name.startswith(prefix):
+                    yield name
+        return _walker(self.pool, 0)
+
+    def list_shards(self):
+        # A shard per leaf directory of the pool:
+        return ['%0*x' % (self.POOL_NAME_DEPTH, x) for x in range(16 ** self.POOL_NAME_DEPTH)]
+
     def delete(self, ref):
         os.unlink(self._get_pool_name(ref))
 
+    def delete_many(self, refs, before=None):
+        if before is None:
+            return super(Filesystem, self).delete_many(refs)
+        deleted = []
+        for ref in refs:
+            filename = self._get_pool_name(ref)
+            trashed = os.path.join(self.trash, ref)
+            try:
+                if os.stat(filename).st_mtime >= before:
+                    continue
+                # Move the object out of the pool before checking its mtime
+                # again, so a concurrent touch is either seen or fails:
+                os.rename(filename, trashed)
+            except FileNotFoundError:
+                continue
+            if os.stat(trashed).st_mtime >= before:
+                try:
+                    os.link(trashed, filename)  # Reused meanwhile, put it back
+                except FileExistsError:
+                    pass  # Ingested again meanwhile
+            else:
+                deleted.append(ref)
+            os.unlink(trashed)
+        return deleted
+
+    def get_blob(self, ref):
+        blob = super().get_blob(ref)
+        if blob is not None:
+            blob.local = True
+        return blob
+
     def open(self, ref):
         return open(self._get_pool_name(ref), 'rb')
 
@@ -97,6 +243,16 @@ class Filesystem(Storage):
     def exists(self, filename):
         return os.path.exists(self._get_pool_name(filename))
 
+    def mtime(self, ref):
+        return os.stat(self._get_pool_name(ref)).st_mtime
+
+    def touch(self, ref):
+        try:
+            os.utime(self._get_pool_name(ref))
+        except FileNotFoundError:
+            return False
+        return True
+
     def read_label(self, name):
         self.check_label(name, raise_error=True)
         filename = self._get_label_name(name)
@@ -113,6 +269,13 @@ class Filesystem(Storage):
         self._makedirs(os.path.dirname(filename))
         open(filename, 'w').write(ref)
 
+    def delete_label(self, name):
+        self.check_label(name, raise_error=True)
+        try:
+            os.unlink(self._get_label_name(name))
+        except FileNotFoundError:
+            raise RuntimeError('Unknown label %s' % name)
+
     def list_labels(self):
         for dirpath, dirnames, filenames in os.walk(self.labels):
             prefix = os.path.relpath(dirpath, self.labels)
@@ -120,3 +283,56 @@ class Filesystem(Storage):
                 prefix = ''
             for filename in filenames:
                 yield os.path.join(prefix, filename)
+
+    def open_refcounts(self):
+        return RefcountIndex(os.path.join(self.location, 'refcounts.sqlite'))
+
+    def open_checklog(self):
+        return CheckLog(os.path.join(self.location, 'checks.sqlite'))
+
+    def open_marks(self, ref):
+        try:
+            return open(os.path.join(self.marks, ref), 'rb')
+        except FileNotFoundError:
+            return None
+
+    def write_marks(self, ref, marks):
+        with tempfile.NamedTemporaryFile(dir=self.marks, delete=False) as ftemp:
+            ftemp.write(marks)
+        os.rename(ftemp.name, os.path.join(self.marks, ref))
+
+    def delete_marks(self, ref):
+        try:
+            os.unlink(os.path.join(self.marks, ref))
+        except FileNotFoundError:
+            pass
+
+    def list_marks(self):
+        return (x for x in os.listdir(self.marks) if not x.startswith('tmp'))
+
+    def open_session(self, roots=()):
+        session = uuid.uuid4().hex
+        with open(os.path.join(self.sessions, session), 'w') as fsession:
+            json.dump({'start': time.time(),
+                       'roots': list(roots),
+                       'host': socket.gethostname(),
+                       'pid': os.getpid()}, fsession)
+        return session
+
+    def close_session(self, session):
+        try:
+            os.unlink(os.path.join(self.sessions, session))
+        except FileNotFoundError:
+            pass
+
+    def list_sessions(self):
+        for session in os.listdir(self.sessions):
+            try:
+                with open(os.path.join(self.sessions, session)) as fsession:
+                    attrs = json.load(fsession)
+            except (FileNotFoundError, ValueError):
+                continue  # Closed or not yet written session
+            if attrs['host'] == socket.gethostname() and not _process_exists(attrs['pid']):
+                self.close_session(session)  # Session of a dead process
+                continue
+            yield session, attrs['start'], attrs['roots']
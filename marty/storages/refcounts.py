@@ -0,0 +1,96 @@
+""" Reference count index of objects.
+"""
+
+import sqlite3
+import threading
+import contextlib
+
+
+class RefcountIndex(object):
+
+    """ Persistent index of the reference count and size of objects.
+
+    The count of an object is the number of labels (for backups) or of
+    distinct referencing objects (for trees and blobs) using it, objects
+    having no reference are not stored. The index is stored in a SQLite
+    database, modifications must be done in a transaction. An index which
+    has never been built (or which has been invalidated) is empty and must
+    be rebuilt before use.
+    """
+
+    def __init__(self, filename):
+        self._db = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS objects '
+                         '(ref BLOB PRIMARY KEY, count INTEGER NOT NULL, size INTEGER NOT NULL) '
+                         'WITHOUT ROWID')
+        self._lock = threading.RLock()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """ Run a block of operations in an exclusive transaction.
+        """
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            else:
+                self._db.execute('COMMIT')
+
+    def is_built(self):
+        """ Check if the index has been built from the labels of the storage.
+        """
+        with self._lock:
+            return bool(self._db.execute('PRAGMA user_version').fetchone()[0])
+
+    def set_built(self, built):
+        """ Mark the index as built, or as invalid if built is False.
+        """
+        with self._lock:
+            self._db.execute('PRAGMA user_version = %d' % bool(built))
+
+    def get(self, ref):
+        """ Get the (count, size) of an object, or None if not referenced.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT count, size FROM objects WHERE ref = ?',
+                                   (bytes.fromhex(ref),)).fetchone()
+        return row
+
+    def update(self, changes):
+        """ Update the index from a dict ref -> (count, size).
+
+        Objects with a null count are removed.
+        """
+        with self._lock:
+            self._db.executemany('DELETE FROM objects WHERE ref = ?',
+                                 ((bytes.fromhex(k),) for k, (c, s) in changes.items() if not c))
+            self._db.executemany('INSERT OR REPLACE INTO objects VALUES (?, ?, ?)',
+                                 ((bytes.fromhex(k), c, s) for k, (c, s) in changes.items() if c))
+
+    def clear(self):
+        """ Remove all objects from the index.
+        """
+        with self._lock:
+            self._db.execute('DELETE FROM objects')
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+
+    def __iter__(self):
+        """ Iterate over the digests of referenced objects, in ascending order.
+        """
+        with self._lock:
+            cursor = self._db.execute('SELECT ref FROM objects ORDER BY ref')
+            rows = cursor.fetchmany(1000)
+        while rows:
+            for row in rows:
+                yield row[0]
+            with self._lock:
+                rows = cursor.fetchmany(1000)
+
+    def close(self):
+        self._db.close()
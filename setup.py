@@ -34,9 +34,16 @@ setup(name='marty',
                                        'restore = marty.commands.restore:Restore',
                                        'check = marty.commands.check:Check',
                                        'mount = marty.commands.mount:Mount',
-                                       'explore = marty.commands.mount:Explore'],
+                                       'explore = marty.commands.mount:Explore',
+                                       'diff = marty.commands.diff:Diff',
+                                       'du = marty.commands.du:Du',
+                                       'delete = marty.commands.delete:Delete',
+                                       'fsck = marty.commands.fsck:Fsck'],
                     'marty.storages': ['filesystem = marty.storages.filesystem:Filesystem'],
                     'marty.remotemethods': ['local = marty.remotemethods.local:Local',
                                             'ssh = marty.remotemethods.ssh:SSH',
+                                            'exec = marty.remotemethods.exec:Exec',
+                                            'ssh-exec = marty.remotemethods.ssh:SSHExec',
+                                            'tar = marty.remotemethods.tar:Tar',
                                             'mikrotik = marty.remotemethods.ssh:Mikrotik']},
-      install_requires=['confiture', 'paramiko', 'arrow', 'msgpack-python', 'humanize', 'llfuse'])
+      install_requires=['confiture', 'paramiko', 'arrow', 'msgpack>=0.4.0,<1.0', 'humanize', 'llfuse'])
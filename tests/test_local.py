@@ -0,0 +1,55 @@
+import os
+
+from confiture import Confiture
+
+from marty.storages.filesystem import Filesystem
+from marty.remotemethods.local import Local
+from marty.operations.backup import create_backup
+from marty.operations.restore import restore
+
+
+def _config(schema, text, args=''):
+    return schema.validate(Confiture('section %s {\n%s\n}\n' % (args, text)).parse().subsection('section'))
+
+
+def test_backup_marty_exclude_with_dotfiles_excluded(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'excluded').mkdir(parents=True)
+    (source / 'excluded' / '.marty-exclude').write_bytes(b'')
+    (source / 'excluded' / 'data').write_bytes(b'data')
+    (source / '.hidden').write_bytes(b'hidden')
+    (source / 'kept').write_bytes(b'kept')
+
+    storage = Filesystem('storage', _config(Filesystem.config_schema,
+                                            'type = "filesystem"\nlocation = "%s"' % (tmp_path / 'storage')))
+    remote = Local('local', _config(Local.config_schema, 'method = "local"\nroot = "%s"\nexcludes = "**/.*"'
+                                    % source, '"local"'))
+    ref, backup = create_backup(storage, remote)
+    assert not backup.errors
+
+    tree = storage.get_tree(backup.root)
+    assert sorted(tree.names()) == [b'excluded', b'kept']
+    assert list(storage.get_tree(tree[b'excluded'].ref).items()) == []
+
+
+def test_restore_metadata(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'dir').mkdir(parents=True)
+    (source / 'dir' / 'file').write_bytes(b'data')
+    (source / 'dir' / 'link').symlink_to('file')
+    os.utime(str(source / 'dir' / 'file'), (1000000000, 1000000000))
+    os.utime(str(source / 'dir' / 'link'), (1050000000, 1050000000), follow_symlinks=False)
+    os.utime(str(source / 'dir'), (1100000000, 1100000000))
+
+    storage = Filesystem('storage', _config(Filesystem.config_schema,
+                                            'type = "filesystem"\nlocation = "%s"' % (tmp_path / 'storage')))
+    remote = Local('local', _config(Local.config_schema, 'method = "local"\nroot = "%s"' % source, '"local"'))
+    ref, backup = create_backup(storage, remote)
+
+    target = tmp_path / 'target'
+    target.mkdir()
+    local = Local('local', _config(Local.config_schema, 'method = "local"\nroot = "%s"' % target, '"local"'))
+    restore(storage, local, storage.get_tree(backup.root))
+
+    for name in ('dir', 'dir/file', 'dir/link'):
+        assert os.lstat(str(target / name)).st_mtime == os.lstat(str(source / name)).st_mtime
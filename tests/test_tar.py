@@ -0,0 +1,58 @@
+import os
+import tarfile
+
+from confiture import Confiture
+
+from marty.storages.filesystem import Filesystem
+from marty.remotemethods.local import Local
+from marty.remotemethods.tar import Tar
+from marty.operations.backup import create_backup
+from marty.operations.restore import restore
+
+
+def _config(schema, text, args=''):
+    return schema.validate(Confiture('section %s {\n%s\n}\n' % (args, text)).parse().subsection('section'))
+
+
+def test_backup_and_restore_tar(tmp_path):
+    source = tmp_path / 'source'
+    (source / 'dir').mkdir(parents=True)
+    (source / 'dir' / 'big').write_bytes(os.urandom(100000))
+    (source / 'small').write_bytes(b'small')
+    os.link(str(source / 'dir' / 'big'), str(source / 'link'))
+    archive = str(tmp_path / 'archive.tar')
+    with tarfile.open(archive, 'w', format=tarfile.GNU_FORMAT) as tar:
+        tar.add(str(source), 'source')
+
+    storage = Filesystem('storage', _config(Filesystem.config_schema,
+                                            'type = "filesystem"\nlocation = "%s"' % (tmp_path / 'storage')))
+    remote = Tar('tar', _config(Tar.config_schema, 'method = "tar"\npath = "%s"' % archive, '"tar"'))
+    ref, backup = create_backup(storage, remote)
+    assert not backup.errors
+
+    target = tmp_path / 'target'
+    target.mkdir()
+    local = Local('local', _config(Local.config_schema, 'method = "local"\nroot = "%s"' % target, '"local"'))
+    restore(storage, local, storage.get_tree(backup.root))
+
+    for name in ('dir/big', 'small', 'link'):
+        assert (target / 'source' / name).read_bytes() == (source / name).read_bytes()
+
+
+def test_backup_tar_missing_hardlink_target(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    (source / 'excluded').write_bytes(b'data')
+    os.link(str(source / 'excluded'), str(source / 'link'))
+    archive = str(tmp_path / 'archive.tar')
+    with tarfile.open(archive, 'w') as tar:
+        tar.add(str(source / 'excluded'), 'excluded')
+        tar.add(str(source / 'link'), 'link')
+
+    storage = Filesystem('storage', _config(Filesystem.config_schema,
+                                            'type = "filesystem"\nlocation = "%s"' % (tmp_path / 'storage')))
+    remote = Tar('tar', _config(Tar.config_schema, 'method = "tar"\npath = "%s"\nexcludes = "/excluded"'
+                                % archive, '"tar"'))
+    ref, backup = create_backup(storage, remote)
+    assert list(backup.errors) == [b'/link']
+    assert list(storage.get_tree(backup.root).items()) == []